@@ -0,0 +1,10 @@
+from django.forms import ModelForm
+
+from fish.bench.models import EncounterTag
+
+
+class EncounterTagCSVForm(ModelForm):
+    """The parent is set from the barcode column, not by the form."""
+    class Meta:
+        model = EncounterTag
+        exclude = ('fishencounter',)
@@ -0,0 +1,56 @@
+"""
+Synthetic models covering the column types csvtool handles: plain columns, 
+a foreign key, a choice field and a parent_key child table.
+"""
+from django.db import models
+
+
+class FishEncounter(models.Model):
+    barcode = models.CharField(max_length=32, unique=True)
+    
+    class Meta:
+        app_label = 'bench'
+
+
+class Species(models.Model):
+    name = models.CharField(max_length=64)
+    
+    class Meta:
+        app_label = 'bench'
+    
+    def __str__(self):
+        return self.name
+
+
+class PlainRecord(models.Model):
+    """Plain columns only."""
+    name = models.CharField(max_length=64)
+    count = models.IntegerField()
+    weight = models.DecimalField(max_digits=8, decimal_places=2)
+    seen = models.DateField()
+    note = models.CharField(max_length=64, blank=True, null=True)
+    
+    class Meta:
+        app_label = 'bench'
+
+
+class ChoiceRecord(models.Model):
+    """A foreign key and a choice column."""
+    KINDS = (('A', 'Adult'), ('J', 'Juvenile'), ('U', 'Unknown'))
+    
+    species = models.ForeignKey(Species, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=1, choices=KINDS)
+    length = models.IntegerField()
+    
+    class Meta:
+        app_label = 'bench'
+
+
+class EncounterTag(models.Model):
+    """Child of FishEncounter, imported by barcode through parent_key."""
+    fishencounter = models.ForeignKey(FishEncounter, on_delete=models.CASCADE)
+    tag = models.CharField(max_length=32)
+    length = models.IntegerField()
+    
+    class Meta:
+        app_label = 'bench'
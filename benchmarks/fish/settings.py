@@ -0,0 +1,33 @@
+"""
+Settings for the synthetic 'fish' project the benchmarks run csvtool.py in.
+"""
+import os
+import tempfile
+
+ROOT_PATH = os.path.dirname(os.path.abspath(__file__))
+TEMP_DIR = os.environ.get('CSVTOOL_BENCH_TEMP') or tempfile.mkdtemp(prefix='csvtool_bench_')
+
+# csvtool counts queries without DEBUG, which would keep every query in memory.
+DEBUG = False
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+        'USER': '',
+        'PASSWORD': '',
+    }
+}
+
+INSTALLED_APPS = ['fish.bench']
+SECRET_KEY = 'csvtool-benchmarks'
+USE_TZ = False
+DATE_INPUT_FORMATS = ('%Y-%m-%d', '%m/%d/%Y')
+
+CSVTOOL_MODELS = {
+    'bench.FishEncounter': {'duplicate_entry':'add'},
+    'bench.PlainRecord': {'duplicate_entry':'overwrite'},
+    'bench.ChoiceRecord': {'duplicate_entry':'overwrite'},
+    'bench.EncounterTag': {'duplicate_entry':'overwrite',
+                           'parent_key':'fishencounter__barcode'},
+}
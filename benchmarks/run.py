@@ -0,0 +1,349 @@
+"""
+Benchmarks for csvtool.py against an in-memory SQLite database.
+
+Measures throughput, peak memory and query counts of validate_csv, save_csv,
+validate_csv + save_csv with the plan, get_fields_body and qs2response
+(plain and streamed) for the synthetic models in fish/bench, with every
+duplicate_entry mode for the imports. import_bundle loads new FishEncounter
+parents and new EncounterTag children by parent_key in one bundle.
+
+    python benchmarks/run.py
+    python benchmarks/run.py --sizes 1000,10000,100000,1000000
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --baseline benchmarks/baseline.json
+
+Each case runs in its own process, so the peak memory (ru_maxrss) of one
+case does not leak into the next. Query counts come from the timings of 
+each run, see csvtool._Timings.
+"""
+from __future__ import print_function
+
+import argparse
+import csv
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+IMPORTS = ('validate_csv', 'save_csv', 'validate_save')
+EXPORTS = ('get_fields_body', 'qs2response', 'qs2response_stream')
+BUNDLES = ('import_bundle',)
+MODELS = ('bench.PlainRecord', 'bench.ChoiceRecord', 'bench.EncounterTag')
+MODES = ('add', 'ignore', 'overwrite')
+SPECIES = 10
+TOLERANCE = 0.10  # Allowed change against the baseline before it is a regression
+
+
+def setup_django():
+    sys.path[:0] = [HERE, ROOT]
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'fish.settings'
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()
+
+
+def create_tables():
+    from django.db import connection
+    from fish.bench import models
+
+    if hasattr(connection, 'schema_editor'):
+        with connection.schema_editor() as editor:
+            for model in (models.FishEncounter, models.Species, models.PlainRecord,
+                          models.ChoiceRecord, models.EncounterTag):
+                editor.create_model(model)
+    else:
+        from django.core.management import call_command
+        call_command('syncdb', interactive=False, verbosity=0)
+
+
+def _insert(model, objs):
+    if hasattr(model.objects, 'bulk_create'):
+        model.objects.bulk_create(objs, batch_size=500)
+    else:
+        for obj in objs:
+            obj.save()
+
+
+def preload(app_model, size):
+    """
+    Fills the table of app_model with ids 1..size, so the import files hit
+    existing rows and the duplicate_entry mode matters.
+    """
+    from fish.bench import models
+
+    start = datetime.date(2012, 1, 1)
+    if app_model == 'bench.PlainRecord':
+        _insert(models.PlainRecord, [
+            models.PlainRecord(id=i, name="name%d" %i, count=i, weight="%d.50" %(i % 1000),
+                               seen=start + datetime.timedelta(days=i % 365))
+            for i in range(1, size+1)])
+
+    elif app_model == 'bench.ChoiceRecord':
+        _insert(models.Species, [models.Species(id=i, name="species%d" %i)
+                                 for i in range(1, SPECIES+1)])
+        _insert(models.ChoiceRecord, [
+            models.ChoiceRecord(id=i, species_id=i % SPECIES + 1, kind='AJU'[i % 3], length=i % 900)
+            for i in range(1, size+1)])
+
+    else:
+        _insert(models.FishEncounter, [models.FishEncounter(id=i, barcode="BC%07d" %i)
+                                       for i in range(1, size+1)])
+        _insert(models.EncounterTag, [
+            models.EncounterTag(id=i, fishencounter_id=i, tag="T%d" %i, length=i % 900)
+            for i in range(1, size+1)])
+
+
+def write_csv(app_model, size, path):
+    """
+    Writes an upload of size rows for app_model that changes every row.
+    """
+    start = datetime.date(2013, 1, 1)
+    f = open(path, 'w')
+    try:
+        writer = csv.writer(f)
+        if app_model == 'bench.PlainRecord':
+            writer.writerow(['id', 'name', 'count', 'weight', 'seen', 'note'])
+            for i in range(1, size+1):
+                writer.writerow([i, "new%d" %i, i+1, "%d.25" %(i % 1000),
+                                 (start + datetime.timedelta(days=i % 365)).isoformat(), ''])
+        elif app_model == 'bench.ChoiceRecord':
+            writer.writerow(['id', 'species_id', 'kind', 'length'])
+            for i in range(1, size+1):
+                writer.writerow([i, (i+1) % SPECIES + 1, 'UAJ'[i % 3], (i+1) % 900])
+        else:
+            writer.writerow(['barcode', 'tag', 'length'])
+            for i in range(1, size+1):
+                writer.writerow(["BC%07d" %i, "N%d" %i, (i+1) % 900])
+    finally:
+        f.close()
+
+
+def write_bundle(size, parents_path, path):
+    """
+    Writes size new FishEncounter parents and an EncounterTag child for each
+    of them, found by barcode.
+    """
+    f = open(parents_path, 'w')
+    try:
+        writer = csv.writer(f)
+        # A single column header needs the id, see _validate_headers().
+        writer.writerow(['id', 'barcode'])
+        for i in range(size+1, 2*size+1):
+            writer.writerow(['', "BC%07d" %i])
+    finally:
+        f.close()
+    
+    f = open(path, 'w')
+    try:
+        writer = csv.writer(f)
+        writer.writerow(['barcode', 'tag', 'length'])
+        for i in range(size+1, 2*size+1):
+            writer.writerow(["BC%07d" %i, "N%d" %i, i % 900])
+    finally:
+        f.close()
+
+
+def _queries(timings):
+    return timings.get('queries') if timings else None
+
+
+def run_case(operation, app_model, size, mode):
+    """
+    Runs one benchmark case in this process and returns its measurements.
+    """
+    setup_django()
+    from django.core.files import File
+    from fish import settings
+    import csvtool
+
+    create_tables()
+    preload(app_model, size)
+
+    tool = csvtool.CSVTool(app_model)
+    if mode:
+        tool.options['duplicate_entry'] = mode
+    path = os.path.join(settings.TEMP_DIR, "upload.csv")
+    parents_path = os.path.join(settings.TEMP_DIR, "parents.csv")
+    if operation in IMPORTS:
+        write_csv(app_model, size, path)
+    elif operation in BUNDLES:
+        write_bundle(size, parents_path, path)
+    qs = tool.model.objects.all()
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.time()
+    queries = None
+
+    if operation == 'validate_csv':
+        pkg = tool.validate_csv(File(open(path, 'rb')), dict(tool.options))
+        if not pkg['is_valid']:
+            raise SystemExit("Benchmark file did not validate: %s" %pkg['errors'][:3])
+        queries = _queries(pkg['timings'])
+
+    elif operation == 'save_csv':
+        tool._get_parent_key()
+        result = tool.save_csv(File(open(path, 'rb')))
+        queries = _queries(result['timings'])
+
+    elif operation == 'validate_save':
+        f = File(open(path, 'rb'))
+        pkg = tool.validate_csv(f, dict(tool.options, keep_plan=True))
+        if not pkg['is_valid']:
+            raise SystemExit("Benchmark file did not validate: %s" %pkg['errors'][:3])
+        result = tool.save_csv(f, plan=pkg['plan'])
+        if _queries(pkg['timings']) is not None:
+            queries = _queries(pkg['timings']) + _queries(result['timings'])
+
+    elif operation == 'import_bundle':
+        # One worker, the in-memory database is per connection.
+        result = csvtool.import_bundle({'bench.FishEncounter':File(open(parents_path, 'rb')),
+                                        app_model:File(open(path, 'rb'))}, workers=1)
+        if not result['is_valid']:
+            raise SystemExit("Benchmark bundle did not load: %s" %result['errors'])
+        new = tool.model.objects.filter(fishencounter__barcode__gt="BC%07d" %size).count()
+        if new != size:
+            raise SystemExit("Bundle created %d of %d children under new parents" %(new, size))
+        timings = [table['timings'] for table in result['results'].values()]
+        if None not in [_queries(t) for t in timings]:
+            queries = sum(_queries(t) for t in timings)
+    
+    elif operation == 'get_fields_body':
+        fields, body = tool.get_fields_body(qs)
+
+    elif operation == 'qs2response':
+        len(tool.qs2response(qs).content)
+        queries = _queries(tool.last_timings)
+
+    elif operation == 'qs2response_stream':
+        for chunk in tool.qs2response(qs, stream=True):
+            pass
+        queries = _queries(tool.last_timings)
+
+    seconds = time.time() - started
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return {'operation':operation, 'model':app_model, 'rows':size, 'mode':mode,
+            'seconds':seconds,
+            'rows_per_sec':size / max(seconds, 1e-6),
+            'peak_rss_kb':rss_after,
+            'peak_rss_delta_kb':rss_after - rss_before,
+            'queries':queries}
+
+
+def iter_cases(operations, models, modes, sizes):
+    for size in sizes:
+        for app_model in models:
+            for operation in operations:
+                if operation in IMPORTS:
+                    for mode in modes:
+                        yield operation, app_model, size, mode
+                elif operation in BUNDLES:
+                    if app_model == 'bench.EncounterTag':
+                        yield operation, app_model, size, None
+                else:
+                    yield operation, app_model, size, None
+
+
+def case_key(operation, app_model, size, mode):
+    return "%s/%s/%d/%s" %(operation, app_model, size, mode or '-')
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the change of every case against the baseline results and returns
+    the keys of the cases that got slower, bigger or ran more queries.
+    """
+    regressions = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        new, old = results[key], baseline[key]
+        speed = new['rows_per_sec'] / max(old['rows_per_sec'], 1e-6)
+        memory = new['peak_rss_delta_kb'] - old['peak_rss_delta_kb']
+
+        problems = []
+        if speed < 1 - tolerance:
+            problems.append("slower")
+        if memory > tolerance * max(old['peak_rss_kb'], 1):
+            problems.append("more memory")
+        if new['queries'] is not None and old['queries'] is not None and new['queries'] > old['queries']:
+            problems.append("more queries")
+        if problems:
+            regressions.append(key)
+
+        print("%-60s speed x%.2f  memory %+d KB  %s" %(key, speed, memory, ", ".join(problems) or "ok"))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument('--sizes', default='1000,10000',
+                        help="comma separated row counts (default 1000,10000)")
+    parser.add_argument('--operations', default=','.join(IMPORTS + EXPORTS + BUNDLES))
+    parser.add_argument('--models', default=','.join(MODELS))
+    parser.add_argument('--modes', default=','.join(MODES))
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="compare against this results JSON file")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--case', nargs=4, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        operation, app_model, size, mode = args.case
+        print(json.dumps(run_case(operation, app_model, int(size), None if mode == '-' else mode)))
+        return 0
+
+    results = {}
+    cases = iter_cases(args.operations.split(","), args.models.split(","),
+                       args.modes.split(","), [int(size) for size in args.sizes.split(",")])
+    for operation, app_model, size, mode in cases:
+        env = dict(os.environ)
+        temp_dir = env['CSVTOOL_BENCH_TEMP'] = tempfile.mkdtemp(prefix='csvtool_bench_')
+        try:
+            out = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__), '--case', operation, app_model,
+                 str(size), mode or '-'], env=env)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        result = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+        key = case_key(operation, app_model, size, mode)
+        results[key] = result
+        print("%-60s %10.0f rows/s  %8d KB  %s queries"
+              %(key, result['rows_per_sec'], result['peak_rss_delta_kb'], result['queries']))
+
+    if args.output:
+        import django
+        f = open(args.output, 'w')
+        try:
+            json.dump({'python':platform.python_version(),
+                       'django':django.get_version(),
+                       'date':datetime.datetime.now().isoformat(),
+                       'results':results}, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    if args.baseline:
+        f = open(args.baseline)
+        try:
+            baseline = json.load(f)['results']
+        finally:
+            f.close()
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("%d regression(s) against %s" %(len(regressions), args.baseline))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
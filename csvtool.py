@@ -8,19 +8,116 @@ Comma Seperated Values format.
 
 """
 import os
+import re
+import shutil
 import datetime as dt
+import base64
+import bz2
 import csv as csv_mod
 import codecs
+import collections
+import contextlib
+import cProfile
+import fcntl
+import gzip
+import hashlib
+import itertools
+import json
+import mmap
+import multiprocessing
+import tempfile
+import threading
+import time
+import types
+import uuid
+import zlib
+import Queue
+from multiprocessing.pool import ThreadPool
+from decimal import Decimal, InvalidOperation
 
-from django.forms import ModelForm
-from django.http import HttpResponse
+from django.conf import settings
+from django.core import serializers
+from django.core.exceptions import NON_FIELD_ERRORS, ValidationError
+from django.db import connections, transaction
+from django.db.models import AutoField, Count, ForeignKey, DateTimeField, Max, Min, get_model
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal
+from django.forms import FileField, ModelChoiceField, ModelForm, ModelMultipleChoiceField
+from django.forms.models import BaseModelForm
+try:
+    from django.forms.utils import ErrorDict, ErrorList
+except ImportError:
+    from django.forms.util import ErrorDict, ErrorList
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils import formats
+try:
+    from django.utils.timezone import now as _now
+except ImportError:
+    _now = dt.datetime.now
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # Older Django versions stream any HttpResponse built from an iterator.
+    StreamingHttpResponse = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from fish.settings import CSVTOOL_MODELS, DATABASES, ROOT_PATH, TEMP_DIR
-from fish.wcgsi.models import FishEncounter
 
 
 REVERT_DT = 1*60*60  # Time in secs 
 FK_LOOKUP_MAX = 20
+FK_LOOKUP_TTL = 10*60  # Time in secs FK lookup codes are cached
+FK_KEYS_CACHE_TABLES = 16  # Reference tables whose keys are kept between uploads
+FK_KEYS_CACHE_ROWS = 10000  # Reference tables up to this many entries have their keys kept
+EXPORT_CHUNK_SIZE = 2000  # Rows fetched per query when streaming an export
+STREAM_BUFFER_ROWS = 500  # Rows written per chunk of a streaming response
+LOOKUP_CHUNK_SIZE = 1000  # Rows per batch of existing object lookups
+BULK_BATCH_SIZE = 500  # Default rows per write batch when bulk_write is on
+VALIDATE_CHUNK_SIZE = 5000  # Default rows per task of parallel validation
+JOB_WORKERS = 2  # Threads running background import jobs
+JOB_DIR = os.path.join(TEMP_DIR, "csvtool_jobs")
+BUNDLE_WORKERS = 4  # Tables of a bundle import validated and saved at the same time
+PREVALIDATE_CHUNK_SIZE = 50000  # Rows per block of columnar pre-validation
+PLAN_MAX_ROWS = 100000  # Rows of a validated import plan kept for save_csv() at most
+ERROR_COLLAPSE_MIN = 10  # Rows a column error repeats on before it is reported once
+SNIFF_SIZE = 2048  # Bytes read to sniff the dialect of an upload
+SPOOL_BUFFER_SIZE = 1024*1024  # Bytes copied per read when spooling an upload
+SPOOL_MMAP_SIZE = 64*1024*1024  # Spooled uploads from this size on are read through mmap
+COMPRESSIONS = {'gzip':('\x1f\x8b', ".gz", 'application/gzip'),
+                'bz2':('BZh', ".bz2", 'application/x-bzip2')}  # magic bytes, extension, content type
+EXPORT_SHARDS_PER_WORKER = 4  # Primary key ranges per worker of export_to_file()
+EXPORT_CACHE_DIR = os.path.join(TEMP_DIR, "csvtool_exports")
+TOMBSTONE_DIR = os.path.join(TEMP_DIR, "csvtool_tombstones")
+TOMBSTONE_MAX_AGE = 30*24*60*60  # Time in secs deletes are kept for delta exports
+EXPORT_CACHE_MAX_AGE = 24*60*60  # Time in secs a cached export is kept
+EXPORT_CACHE_MAX_SIZE = 512*1024*1024  # Bytes of cached exports kept, least recently used go first
+EXPORT_VERSION_MAX = 1024*1024  # Bytes of a shared change counter file before it starts over
+
+_EMPTY_VALUES = (None, '', [], (), {})
+_INT_RE = re.compile(r"^\s*[-+]?\d+(\.0*)?\s*$")
+
+# Per-model metadata shared by all CSVTool instances, see CSVTool._build_meta()
+_REGISTRY = {}
+_REGISTRY_LOCK = threading.Lock()
+_META_ATTRS = ('model', 'form', 'form_engine', 'fields', 'expected', 'table_doc', 
+               'general_doc', 'fks')
+
+# Related model -> (expiry time, lookup codes), see _get_related_lookup_codes()
+_LOOKUP_CACHE = {}
+# (related model, key field) -> (expiry time, table version, keys or None), 
+# least recently used first, see _get_existing_keys()
+_FK_KEYS_CACHE = collections.OrderedDict()
+_FK_KEYS_LOCK = threading.Lock()
+_TABLE_VERSIONS = {}  # model: counter bumped by every change seen in this process
+_SHARED_VERSION_MODELS = None  # Models with a change counter in EXPORT_CACHE_DIR
+
+# Sent after every validate_csv(), save_csv() and qs2response() with 
+# app_model, operation and timings (see _Timings.finish()).
+csv_timings = Signal()
 
 class MultipleEntriesFound(Exception):
     def __inti__(self, value):
@@ -46,30 +143,98 @@ class CSVTool():
     MODELS = CSVTOOL_MODELS.keys()
     OPTIONS = CSVTOOL_MODELS
     tformat = "%Y%m%d_%H%M%S"
+    timing_callback = None  # Set on an instance, called with the timings of every run
+    timings = None
+    last_timings = None
+    last_pkg = None
+    _upload = None
+    _fk_keys = None  # Existing foreign keys of the chunk being validated
+    _chunk_atomic = False  # True while _apply_plan() writes a chunk in one transaction
     
     def __init__(self, app_model):
         """
         app_model [String] in the models list
         APPNAME.MODELNAME (case sensitive)
         
+        The model, form, fields etc. are built once per process and shared 
+        read-only by every CSVTool for the same model. Only the options are 
+        copied so each instance can change its own.
+        
         """   
-        self.model = self._get_model(app_model)
         self.app_model = app_model
         self.value = app_model.replace(".","-")
         
+        meta = _REGISTRY.get(app_model)
+        if meta is None:
+            meta = self._build_meta()
+        
+        for name in _META_ATTRS:
+            setattr(self, name, meta[name])
+        self.options = dict(meta['options'])
+    
+    @classmethod
+    def warm_registry(cls, app_models=None):
+        """
+        Builds the shared metadata for app_models, or all of CSVTOOL_MODELS,
+        so the first request does not have to. Call it at startup, e.g. from
+        urls.py.
+        """
+        for app_model in app_models or cls.MODELS:
+            cls(app_model)
+    
+    @classmethod
+    def invalidate_registry(cls, app_model=None):
+        """
+        Drops the shared metadata for app_model, or for every model, so it is
+        built again by the next CSVTool. Use it after changing a model, its 
+        CSVForm or CSVTOOL_MODELS at runtime.
+        """
+        with _REGISTRY_LOCK:
+            if app_model:
+                _REGISTRY.pop(app_model, None)
+            else:
+                _REGISTRY.clear()
+    
+    def _build_meta(self):
+        """
+        Runs the _get_*() setup for self.app_model and stores the results in 
+        the registry. Returns the registry entry.
+        """
+        self.model = self._get_model(self.app_model)
+        
         self._get_options()
         self._get_form()
+        self._get_form_engine()
         self._get_fields()
         self._get_expected()
         self._get_docs()
-        self._get_lookup_codes()
         self._get_foreign_keys()
         
+        meta = dict((name, getattr(self, name)) for name in _META_ATTRS)
+        meta['options'] = dict(self.options)
+        with _REGISTRY_LOCK:
+            return _REGISTRY.setdefault(self.app_model, meta)
+        
     
-    def qs2response(self, qs):
+    def qs2response(self, qs, stream=False, request=None, compression=None):
         """
         Writes a query set in CSV format based on the input queryset, qs.
         Returns an HttpReponse object containing the csv file.
+        
+        If stream is True the queryset is read EXPORT_CHUNK_SIZE rows at a time
+        and the csv lines are sent as they are generated, so memory use stays
+        flat no matter how many rows are exported. Streamed rows are written 
+        in primary key order.
+        
+        With the export_cache option the finished csv is kept gzipped in 
+        EXPORT_CACHE_DIR and repeat exports of the same query are served 
+        from there until the table changes, see _cached_csv_response(). 
+        Pass the request to answer If-None-Match with 304 Not Modified and 
+        to send the gzipped file as is to clients that accept gzip.
+        
+        compression, 'gzip' or 'bz2' (default the export_compression option),
+        sends the csv as a compressed attachment. It is compressed as it is
+        generated, also when streaming.
         """
         """
         fields = [f['name'] for f in self.fields]
@@ -100,16 +265,195 @@ class CSVTool():
             body.append(row)
         """
         
-        fields, body = self.get_fields_body(qs)
+        if compression is None:
+            compression = self.options['export_compression']
+        
+        self.timings = _Timings(self, 'qs2response')
+        if self.options['export_cache']:
+            response = self._cached_csv_response(qs, stream, request, compression)
+            if response is not None:
+                return response
+        
+        if stream:
+            fields, body = self.iter_fields_body(qs)
+            # The timings are finished when the last line has been sent.
+            return self._make_streaming_csv_response(fields, body, compression=compression)
         
-        out = self._make_csv_response(fields, body)
+        try:
+            with self._phase('query'):
+                fields, body = self.get_fields_body(qs)
+            self.timings.rows = len(body)
+            
+            with self._phase('serialize'):
+                out = self._make_csv_response(fields, body, compression=compression)
+        finally:
+            self.timings.finish()
         
         return out 
     
+    def _cached_csv_response(self, qs, stream, request, compression=None):
+        """
+        Returns the export of qs from the export cache, writing the cache 
+        entry first if there is none, or None if qs can not be cached.
+        
+        Entries are keyed on the model, the sql of qs and the table version
+        (see _table_version()) and change counter (see _shared_version()),
+        so any change to the table starts a new entry and the old one is 
+        evicted by age or size in time. The key is also the ETag of the 
+        response, and the same in every process.
+        """
+        with self._phase('cache'):
+            key = self._export_cache_key(qs)
+        if key is None:
+            return None
+        etag = '"%s%s"' %(key, COMPRESSIONS[compression][1] if compression else "")
+        
+        if request is not None and etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+            self.timings.finish()
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return response
+        
+        if not os.path.isdir(EXPORT_CACHE_DIR):
+            os.makedirs(EXPORT_CACHE_DIR)
+        path = os.path.join(EXPORT_CACHE_DIR, key + ".csv.gz")
+        try:
+            cached = open(path, 'rb')
+        except IOError:
+            cached = None
+        
+        if cached is not None:
+            os.utime(path, None)  # Recently used entries are evicted last
+            self.timings.finish()
+        elif stream:
+            fields, body = self.iter_fields_body(qs)
+            response = self._make_streaming_csv_response(fields, body, cache_path=path,
+                                                         compression=compression)
+            response['ETag'] = etag
+            return response
+        else:
+            fields, body = self.iter_fields_body(qs)
+            lines = self._iter_csv_lines(fields, body, self.timings)
+            for line in _cache_lines(lines, path):
+                pass
+            cached = open(path, 'rb')
+        
+        return self._make_cached_response(cached, etag, stream, request, compression)
+    
+    def _export_cache_key(self, qs):
+        """
+        Returns the export cache key of qs, or None if its sql can not be 
+        built (e.g. an empty __in filter).
+        """
+        try:
+            sql = unicode(qs.query).encode("utf-8")
+        except Exception:
+            return None
+        
+        version = "%s|%s" %(_table_version(self.model), _shared_version(self.model))
+        parent_key = self.options['parent_key']
+        if parent_key:
+            parent_model = self._get_parent_model()
+            version += "|%s|%s" %(_table_version(parent_model), _shared_version(parent_model))
+        fields = ",".join(f['name'] for f in self.fields)
+        return hashlib.sha1("\n".join([self.app_model, parent_key, fields, sql, version])).hexdigest()
+    
     def get_fields_body(self, qs):
         """
         Gets fields and body for csv export. 
         
+        """
+        fields, body = self.iter_fields_body(qs, chunk_size=None)
+        return fields, list(body)
+    
+    def delta2response(self, qs, since=None, stream=False, compression=None):
+        """
+        Same as qs2response() but only exports the rows of qs changed after
+        the watermark since, see get_delta_fields_body(). The new watermark
+        is sent in the X-CSVTool-Watermark header, pass it as since next 
+        time. Without since every row is exported.
+        """
+        self.timings = _Timings(self, 'delta2response')
+        with self._phase('query'):
+            fields, body, watermark = self.get_delta_fields_body(qs, since)
+        
+        if stream:
+            response = self._make_streaming_csv_response(fields, body, compression=compression)
+        else:
+            try:
+                with self._phase('query'):
+                    body = list(body)
+                self.timings.rows = len(body)
+                with self._phase('serialize'):
+                    response = self._make_csv_response(fields, body, compression=compression)
+            finally:
+                self.timings.finish()
+        
+        response['X-CSVTool-Watermark'] = "" if watermark is None else unicode(watermark)
+        return response
+    
+    def get_delta_fields_body(self, qs, since=None):
+        """
+        Same as iter_fields_body() but only for the rows of qs whose 
+        watermark_field (an option, e.g. a modified timestamp or 'id') is 
+        greater than since. Returns fields, body and the new watermark, the
+        largest watermark_field value exported.
+        
+        With the tombstones option, and a DateTimeField watermark_field, rows
+        deleted after since are sent first as tombstones: the id and 1 in an
+        extra 'deleted' column with the other columns empty. Deletes are 
+        recorded by the post_delete signal, see _record_tombstone(), so 
+        deletes in raw sql or from other programs are not seen.
+        """
+        name = self.options['watermark_field']
+        if not name:
+            raise ValueError("%s has no watermark_field in CSVTOOL_MODELS." %self.app_model)
+        field = self.model._meta.get_field(name)
+        
+        if since in (None, ""):
+            since = None
+        else:
+            since = field.to_python(since)
+            qs = qs.filter(**{name+"__gt":since})
+        
+        fields, body = self.iter_fields_body(qs)
+        tombstones = []
+        use_tombstones = (self.options['tombstones'] and since is not None and 
+                          isinstance(field, DateTimeField) and 'id' in fields)
+        if use_tombstones:
+            tombstones = [(deleted, pk) for deleted, pk in _read_tombstones(self.app_model, field, since)
+                          if deleted > since]
+        
+        # Rows changed while the export runs wait for the next watermark.
+        marks = [deleted for deleted, pk in tombstones]
+        marks.append(qs.aggregate(watermark=Max(name))['watermark'])
+        marks = [mark for mark in marks if mark is not None]
+        if marks:
+            watermark = max(marks)
+            fields, body = self.iter_fields_body(qs.filter(**{name+"__lte":watermark}))
+        else:
+            watermark = since
+        
+        if use_tombstones:
+            index = fields.index('id')
+            fields = fields + ['deleted']
+            # Tombstones go first, a row can be deleted and created again.
+            deleted = (self._tombstone_row(fields, index, pk) for deleted, pk in tombstones)
+            body = itertools.chain(deleted, (row + [""] for row in body))
+        return fields, body, watermark
+    
+    def _tombstone_row(self, fields, index, pk):
+        row = [""]*len(fields)
+        row[index] = pk
+        row[-1] = 1
+        return row
+    
+    def iter_fields_body(self, qs, chunk_size=EXPORT_CHUNK_SIZE):
+        """
+        Same as get_fields_body() but the body is returned as a generator.
+        If chunk_size is given the queryset is read chunk_size rows at a time
+        (see _iter_queryset()), otherwise it is iterated in one go.
+        
         """
         fields = [f['name'] for f in self.fields]
         #fields = self.fields
@@ -120,98 +464,665 @@ class CSVTool():
             local_field, parent_field = parent_key.split("__")
             fields.remove('id')
         
-        body = []
-        for q in qs:
-            row = []
-            for f in fields:
-                if local_field+"_id" == f:  # If this is a parent_key 
-                    obj = q.__getattribute__(local_field)
-                    row.append(obj.__getattribute__(parent_field))
-                else: # This is not a parent key 
-                    row.append(q.__getattribute__(f))
-                        
-            body.append(row)
+        # Read every column, including the parent_key column through its 
+        # join, with one values_list() query instead of loading the parent 
+        # object for each row.
+        values = qs.values_list('pk', *self._get_export_lookups(fields, local_field, parent_field))
+        if chunk_size:
+            rows = self._iter_queryset(values, chunk_size)
+        else:
+            rows = values
+        body = (list(row[1:]) for row in rows)
         
         if parent_field:
             index = fields.index(local_field+"_id")
             fields[index] = parent_field
         return fields, body 
+    
+    def export_to_file(self, qs, fname=None, workers=None, parts=False):
+        """
+        Writes qs as csv to fname in TEMP_DIR, header first and the rows in
+        primary key order, for full table dumps. Returns a dict with keys 
+        'fname', 'parts', 'rows' and 'timings'.
+        
+        The primary key range of qs is split into EXPORT_SHARDS_PER_WORKER 
+        shards per worker and the shards are exported at the same time on a
+        pool of workers processes, each with its own database connection 
+        (see _export_shard()). The shard files are joined into fname in
+        order as they finish. With parts=True they are kept instead, each
+        with the header, and listed in 'parts'.
+        
+        Inputs
+        ------
+        fname [STRING] - defaults to _get_fname()+".csv"
+        workers [INT] - defaults to the export_workers option
+        parts [BOOL] - keep one file per shard instead of joining them
+        """
+        if not fname:
+            fname = self._get_fname()+".csv"
+        if not workers:
+            workers = self.options['export_workers']
+        path = os.path.join(TEMP_DIR, fname)
+        
+        self.timings = _Timings(self, 'export_to_file')
+        try:
+            with self._phase('query'):
+                ranges = self._get_pk_ranges(qs, workers*EXPORT_SHARDS_PER_WORKER)
+            
+            tasks = []
+            for i, bounds in enumerate(ranges):
+                part = "%s.part%04d" %(path, i)
+                tasks.append((self.app_model, self.options, qs.query, bounds, part, parts))
+            
+            if workers > 1 and len(tasks) > 1:
+                # Forked workers must not share the parent's database connection.
+                _close_connections()
+                pool = multiprocessing.Pool(workers, initializer=_close_connections)
+                try:
+                    with self._phase('export'):
+                        out = self._join_shards(pool.imap(_export_shard, tasks), tasks, path, parts, qs)
+                    pool.close()
+                finally:
+                    pool.terminate()
+                    pool.join()
+            else:
+                with self._phase('export'):
+                    out = self._join_shards(itertools.imap(_export_shard, tasks), tasks, path, parts, qs)
+        finally:
+            out_timings = self.timings.finish()
+        
+        out['timings'] = out_timings
+        return out
+    
+    def _join_shards(self, results, tasks, path, parts, qs):
+        """
+        Takes the row counts of the export_to_file() shards as they finish 
+        and appends each shard file to path, unless parts is set. Returns 
+        the export_to_file() result without timings.
+        """
+        out = {'fname':os.path.basename(path), 'parts':[], 'rows':0}
+        if parts:
+            for task, rows in itertools.izip(tasks, results):
+                out['parts'].append(os.path.basename(task[4]))
+                out['rows'] += rows
+                self.timings.rows = out['rows']
+            return out
+        
+        fields, body = self.iter_fields_body(qs)
+        f = open(path, 'wb')
+        try:
+            csv_mod.writer(f).writerow(_encode_row(fields))
+            for task, rows in itertools.izip(tasks, results):
+                part = open(task[4], 'rb')
+                try:
+                    shutil.copyfileobj(part, f)
+                finally:
+                    part.close()
+                os.remove(task[4])
+                out['rows'] += rows
+                self.timings.rows = out['rows']
+        finally:
+            f.close()
+        return out
+    
+    def _get_pk_ranges(self, qs, shards):
+        """
+        Splits the primary keys of qs into up to shards (low, high) ranges of
+        equal width. Returns [None], one shard of everything, for empty or 
+        sliced querysets and primary keys that are not integers.
+        """
+        if not qs.query.can_filter():
+            return [None]
+        bounds = qs.aggregate(low=Min('pk'), high=Max('pk'))
+        low, high = bounds['low'], bounds['high']
+        if not isinstance(low, (int, long)) or not isinstance(high, (int, long)):
+            return [None]
+        
+        step = max(-(-(high - low + 1) // shards), 1)
+        return [(start, min(start + step - 1, high)) for start in xrange(low, high + 1, step)]
+    
+    def _get_export_lookups(self, fields, local_field, parent_field):
+        """
+        Returns the values_list() lookup for each export field. Foreign keys
+        are looked up by field name and the parent_key column is followed 
+        through to the parent's field.
+        """
+        names = dict((f.attname, f.name) for f in self.model._meta.fields)
+        lookups = []
+        for f in fields:
+            if local_field+"_id" == f:  # If this is a parent_key 
+                lookups.append(local_field+"__"+parent_field)
+            else:
+                lookups.append(names.get(f, f))
+        return lookups
+    
+    def _iter_queryset(self, qs, chunk_size):
+        """
+        Yields the rows of qs, a values_list() queryset starting with 'pk', 
+        chunk_size at a time. Each chunk is a separate query paged on the 
+        primary key, so neither Django nor the database driver ever holds 
+        more than one chunk. Sliced querysets cannot be paged and are read 
+        with a single iterator().
+        """
+        if not qs.query.can_filter():
+            for row in qs.iterator():
+                yield row
+            return
+        
+        qs = qs.order_by('pk')
+        last_pk = None
+        while True:
+            if last_pk is None:
+                page = qs[:chunk_size]
+            else:
+                page = qs.filter(pk__gt=last_pk)[:chunk_size]
+            
+            count = 0
+            for row in page.iterator():
+                count += 1
+                last_pk = row[0]
+                yield row
+            
+            if count < chunk_size:
+                break
                                    
     def validate_csv(self, file, options = None):
         """
         Validates the given csv (a file-like object) against the form and 
-        returns ['errors'] and ['is_valid']
+        returns ['errors'], ['is_valid'] and ['plan']
+        
+        With the keep_plan option and a valid file of up to PLAN_MAX_ROWS
+        rows ['plan'] is the validated import plan, one entry per row (see 
+        _plan_entry()). Pass it to save_csv() to write the rows without 
+        reading the file or looking up existing entries again. Otherwise 
+        ['plan'] is None and each chunk's entries are dropped once it is
+        validated, so memory use does not grow with the file.
+        
+        With the max_errors option validation stops after that many errors
+        and ['truncated'] is True. With collapse_errors (on by default) an 
+        error that repeats for one column on ERROR_COLLAPSE_MIN rows or more
+        is reported once, see _collapse_errors().
         
+        ['timings'] has the time and query count of each phase, see 
+        _Timings.finish().
+        
+        """
+        pkg = self._start_validation(options)
+        try:
+            for step in self._validate_file(file, pkg):
+                pass
+            self._finish_errors(pkg)
+            if self.options['collapse_errors']:
+                pkg['errors'] = _collapse_errors(pkg['errors'])
+            return pkg
+        finally:
+            self._end_validation(pkg)
+    
+    def iter_validate_csv(self, file, options = None):
+        """
+        Same as validate_csv() but yields the errors as they are found, so a
+        view can stream them while the rest of the file is validated. Once 
+        an error has repeated ERROR_COLLAPSE_MIN times for a column it is 
+        only counted, and reported once more at the end for all its rows. 
+        When the generator is done last_pkg holds the validate_csv() result.
+        """
+        pkg = self._start_validation(options)
+        self.last_pkg = pkg
+        collapse = self.options['collapse_errors']
+        counts = _ErrorCounts()
+        reported = 0
+        try:
+            for step in self._validate_file(file, pkg):
+                for error in pkg['errors'][reported:]:
+                    if collapse:
+                        counts.add(error)
+                        error = counts.strip(error, counts.repeated(ERROR_COLLAPSE_MIN + 1))
+                    if error:
+                        yield error
+                reported = len(pkg['errors'])
+            
+            self._finish_errors(pkg)
+            for error in pkg['errors'][reported:]:
+                yield error
+            if collapse:
+                for error in counts.summaries(ERROR_COLLAPSE_MIN + 1):
+                    yield error
+                pkg['errors'] = _collapse_errors(pkg['errors'])
+        finally:
+            self._end_validation(pkg)
+    
+    def _start_validation(self, options):
+        """
+        Sets up a validate_csv() run and returns its empty pkg.
         """
-                       
         if options:
             for key in self.options:
                 if not key in options.keys():
                     options.update({key:self.options[key]})
+            self.options = options
         
-        self.options = options
-        
-        pkg = {
+        self.timings = _Timings(self, 'validate_csv')
+        return {
             'errors': [],
             'is_valid': False,
+            'plan': None,
+            'truncated': False,
         }
-        
+    
+    def _end_validation(self, pkg):
+        if not pkg['is_valid']:
+            # No save_csv() follows, drop the spooled copy now.
+            self._close_upload()
+        pkg['timings'] = self.timings.finish()
+    
+    def _errors_spent(self, pkg):
+        """
+        Returns True once pkg has max_errors errors, and marks it truncated.
+        """
+        max_errors = self.options['max_errors']
+        if max_errors and len(pkg['errors']) >= max_errors:
+            pkg['truncated'] = True
+            return True
+        return False
+    
+    def _finish_errors(self, pkg):
+        """
+        Cuts the errors of a truncated validation to max_errors and says so.
+        """
+        if pkg['truncated']:
+            del pkg['errors'][self.options['max_errors']:]
+            pkg['errors'].append({'row':None, 'msg':"Validation stopped after %d errors. Please fix them and upload the file again." %self.options['max_errors']})
+    
+    def _validate_file(self, file, pkg):
+        """
+        Does the work of validate_csv(). A generator that fills pkg and 
+        yields after every step that can add errors, for iter_validate_csv().
+        """
         ############## Validate file and see if we can read the headers. ###############
-        head = codecs.EncodedFile(file,"utf-8").read(2048)
+        with self._phase('sniff'):
+            upload = self._open_upload(file)
+        if upload.error:
+            pkg['errors'].append(upload.error)
+            pkg['is_valid'] = False
+            return
         try:
-            dialect = csv_mod.Sniffer().sniff(head)
+            with self._phase('sniff'):
+                upload.dialect()
         except:
             pkg['errors'].append("""  Could not read file. Is it empty? Are you using 
                                     commas as delimiters? Please check your file
-                                     to make sure it has the correct format. <br />File preview: %s""" %head)
+                                     to make sure it has the correct format. <br />File preview: %s""" %upload.head())
             pkg['is_valid'] = False
-            return pkg
+            return
         ##############################################################################
         
-        file.open() 
-        csv = csv_mod.DictReader( codecs.EncodedFile(file,"utf-8"), dialect=dialect )
+        csv = upload.rows()
         
         try:
-            fieldnames = csv.fieldnames
+            fieldnames = csv.next()
         except:
             pkg['errors'].append("Could not read headers. Please check your file to make sure it has headers in the correct format.")
             pkg['is_valid'] = False
-            return pkg
+            return
                       
         if not self._validate_headers(fieldnames, pkg):
-            return pkg
+            return
+        self._compile_converter(fieldnames)
                 
         self.created = []
         self.overwritten = 0
         self.ignored = 0        
+        self.unchanged = 0
         
         ################ Try to get the first row of data, if not there return error ############## 
+        csv = (row for row in csv if row)  # skip blank lines like DictReader
         try:
             row = csv.next()
         except StopIteration:
             pkg['errors'].append("No rows found. Please check your file and verify it has data in the proper format.")
             pkg['is_valid'] = False
-            return pkg
+            return
         ###########################################################################################
         
-        row_num=1
-        while row:
-            row_num +=1
+        rows = itertools.chain([row], csv)
+        if self.options['prevalidate']:
+            with self._phase('prevalidate'):
+                valid = self._prevalidate(fieldnames, rows, pkg)
+            if not valid:
+                pkg['is_valid'] = False
+                yield
+                return
             
-            row = self._convert_fk_names(row)
-                           
-                
-            self._validate_row(row, options, pkg, row_num)
-            try:
-                row = csv.next()  
-            except StopIteration:
-                row = False
+            # Read the rows again for the form validation.
+            csv = upload.rows()
+            csv.next()
+            rows = (row for row in csv if row)
+        
+        plan = [] if self.options['keep_plan'] else None
+        if self.options['validate_workers'] > 1:
+            steps = self._validate_parallel(fieldnames, rows, pkg)
+        else:
+            steps = self._iter_plan_chunks(rows, pkg)
+        for entries in steps:
+            if entries is None or plan is None:
+                plan = None  # See _validate_parallel()
+            elif len(plan) + len(entries) > PLAN_MAX_ROWS:
+                plan = None  # Too big to hold, save_csv() reads the file again
+            else:
+                plan.extend(entries)
+            yield
         
         pkg['is_valid'] = not pkg['errors']    
-        return pkg
+        if pkg['is_valid']:
+            pkg['plan'] = plan
+    
+    def _prevalidate(self, headers, rows, pkg):
+        """
+        Checks whole columns for missing required values, integers, decimals,
+        dates and choices before any form is built. The rows are read in 
+        blocks of PREVALIDATE_CHUNK_SIZE and each block is checked column by 
+        column (with NumPy when it is installed). Errors are added to pkg in 
+        the same format as form errors. Returns True if no errors were found.
+        
+        Values that fail a check are confirmed with the form field's clean(),
+        so the checks are never stricter than the form. With duplicate_entry
+        ignore, rows with an id are left out: they may be skipped without a 
+        form. A file that passes still goes through the full form validation.
+        """
+        checks = self._get_column_checks(headers)
+        if not checks:
+            return True
+        
+        pk = self._get_parent_key()
+        pk_index = None
+        if self.options['duplicate_entry'] == 'ignore' and pk in headers:
+            pk_index = headers.index(pk)
+        
+        errors = {}  # row_num: ErrorDict
+        row_num = 1
+        for block in self._iter_chunks(rows, PREVALIDATE_CHUNK_SIZE):
+            self.timings.rows = row_num - 1 + len(block)
+            skip = set()
+            if pk_index is not None:
+                skip = set(i for i, row in enumerate(block) 
+                           if pk_index < len(row) and row[pk_index])
+            for index, name, kind, formfield, extra in checks:
+                column = [row[index] if index < len(row) else None for row in block]
+                
+                filled = []
+                for i, value in enumerate(column):
+                    if i in skip:
+                        continue
+                    if value:
+                        filled.append(i)
+                    elif formfield.required:
+                        self._add_column_error(errors, row_num+1+i, name, 
+                                               formfield.error_messages['required'])
+                
+                if kind is None or not filled:
+                    continue
+                values = [column[i] for i in filled]
+                for i in _bad_values(kind, values, extra):
+                    # Let the form field confirm the error and word it.
+                    try:
+                        formfield.clean(values[i])
+                    except ValidationError as e:
+                        for message in e.messages:
+                            self._add_column_error(errors, row_num+1+filled[i], name, message)
+            
+            row_num += len(block)
+            if self.options['max_errors'] and len(errors) >= self.options['max_errors']:
+                pkg['truncated'] = True
+                break
+        
+        for num in sorted(errors):
+            pkg['errors'].append({'row':num, 'msg':errors[num]})
+        return not errors
+    
+    def _add_column_error(self, errors, row_num, name, message):
+        msg = errors.setdefault(row_num, ErrorDict())
+        msg.setdefault(name, ErrorList()).append(unicode(message))
+    
+    def _get_column_checks(self, headers):
+        """
+        Returns (column index, field name, kind, form field, extra) for each 
+        column _prevalidate() can check. kind is 'int', 'decimal', 'date', 
+        'datetime', 'choice' or None (only the required check). extra is the
+        set of choices or the list of date input formats.
+        
+        Primary keys, foreign keys, the parent_key column and fields with a 
+        clean_<field> method on the form are left to the form.
+        """
+        self._get_parent_key()
+        by_name = dict((field['name'], field) for field in self.fields)
+        model_fields = dict((f.attname, f) for f in self.model._meta.fields)
+        checks = []
+        for index, header in enumerate(headers):
+            field = by_name.get(header)
+            model_field = model_fields.get(header)
+            if not field or field['related_model'] or model_field.primary_key:
+                continue
+            if header == self.parent_field or hasattr(self.form, 'clean_'+header):
+                continue
+            formfield = self.form.base_fields.get(model_field.name)
+            if formfield is None:
+                continue
+            
+            kind = _column_kind(field['db_type'])
+            extra = None
+            if model_field.choices:
+                kind = 'choice'
+                extra = set(unicode(key) for key, label in model_field.flatchoices)
+            elif kind in ('date', 'datetime'):
+                extra = getattr(formfield, 'input_formats', None)
+                if not extra:
+                    extra = formats.get_format(kind.upper()+'_INPUT_FORMATS')
+                extra = list(extra)
+            
+            if kind or formfield.required:
+                checks.append((index, model_field.name, kind, formfield, extra))
+        return checks
+    
+    def _iter_plan(self, csv, pkg, row_num=1, in_file=True):
+        """
+        Validates the rows of csv chunk by chunk and yields the plan entry of
+        every valid row. Errors are added to pkg['errors']. row_num is the 
+        file row number before the first row of csv.
+        """
+        for entries in self._iter_plan_chunks(csv, pkg, row_num, in_file):
+            for entry in entries:
+                yield entry
+    
+    def _iter_plan_chunks(self, csv, pkg, row_num=1, in_file=True):
+        """
+        Same as _iter_plan() but yields the plan entries of each chunk as a 
+        list, also when the chunk had no valid rows. Stops once max_errors
+        is reached.
+        
+        Unique fields of rows validated by the form engine are checked per 
+        chunk, against the table and, with in_file, against the earlier rows
+        of csv. See _check_unique().
+        """
+        pk = self._get_parent_key()
+        seen = {} if in_file else None
+        chunks = self._iter_chunks(csv)
+        while True:
+            with self._phase('parse'):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            with self._phase('convert'):
+                rows = [self._convert_row(row) for row in chunk]
+            with self._phase('lookup'):
+                resolved = self._resolve_ids(self._get_row_ids(rows, pk))
+                if self._preload_fks():
+                    self._fk_keys = self.form_engine.preload(rows)
+            
+            # Validate the whole chunk before yielding so the phase times do
+            # not include the caller's work.
+            entries = []
+            spent = False
+            errors = len(pkg['errors']) if pkg is not None else 0
+            with self._phase('validate'):
+                for row in rows:
+                    row_num +=1
+                    entry = self._validate_row(row, self.options, pkg, row_num, resolved)
+                    if entry:
+                        entries.append(entry)
+                    elif pkg is not None and self._errors_spent(pkg):
+                        spent = True
+                        break
+            self._fk_keys = None
+            if self._batch_unique():
+                with self._phase('unique'):
+                    entries = self._check_unique(entries, pkg, seen)
+                if pkg is not None:
+                    pkg['errors'][errors:] = sorted(pkg['errors'][errors:], key=_error_row)
+                    spent = spent or self._errors_spent(pkg)
+            if self.timings:
+                self.timings.rows = row_num - 1
+            
+            yield entries
+            if spent:
+                break
+    
+    def _preload_fks(self):
+        """
+        Returns True if the foreign keys of each chunk are looked up at once
+        for the form engine, see _FormEngine.preload().
+        """
+        return (self.form_engine.usable and self.options['compile_form'] and 
+                self.options['preload_fks'] and bool(self.form_engine.foreign_keys))
+    
+    def _batch_unique(self):
+        """
+        Returns True if rows are validated by the form engine, which leaves 
+        the unique checks to _check_unique().
+        """
+        return (self.form_engine.usable and self.options['compile_form'] and 
+                bool(self.form_engine.unique_checks))
+    
+    def _check_unique(self, entries, pkg, seen=None, db=True):
+        """
+        Batched ModelForm.validate_unique() for the plan entries of a chunk.
+        The values of each unique field and unique_together set are checked 
+        against the table with one IN query per set (if db) and against the
+        earlier rows of the file in seen, {set: {values: (row, pk)}}, if it
+        is given. Rows that fail get their error in pkg, or raise a 
+        ValueError if pkg is None, and are left out of the returned entries.
+        """
+        failed = {}  # row: ErrorDict
+        for names, attnames in self.form_engine.unique_checks:
+            keyed = []
+            for entry in entries:
+                if entry['instance'] is None:
+                    continue
+                key = tuple(getattr(entry['instance'], attname) for attname in attnames)
+                if not None in key:
+                    keyed.append((key, entry))
+            if not keyed:
+                continue
+            
+            existing = {}
+            if db:
+                existing = self._get_existing_unique(names, [key for key, entry in keyed])
+            for key, entry in keyed:
+                instance = entry['instance']
+                message = None
+                if existing.get(key, set()) - set([instance.pk]):
+                    message = self._unique_message(instance, names)
+                elif seen is not None:
+                    first = seen.setdefault(names, {}).setdefault(key, (entry['row'], instance.pk))
+                    if first[0] != entry['row'] and (instance.pk is None or first[1] != instance.pk):
+                        labels = [unicode(self.model._meta.get_field(name).verbose_name) 
+                                  for name in names]
+                        message = u"Row %s of the file has the same %s." %(first[0], u" and ".join(labels))
+                if message:
+                    name = names[0] if len(names) == 1 else NON_FIELD_ERRORS
+                    msg = failed.setdefault(entry['row'], ErrorDict())
+                    msg.setdefault(name, ErrorList()).append(message)
+        
+        if not failed:
+            return entries
+        for row_num in sorted(failed):
+            if pkg is None:
+                raise ValueError("Row %s could not be saved: %s" %(row_num, failed[row_num]))
+            pkg['errors'].append({'row':row_num, 'msg':failed[row_num]})
+        return [entry for entry in entries if not entry['row'] in failed]
+    
+    def _get_existing_unique(self, names, keys):
+        """
+        Returns {values: set of pks} of the entries whose fields names have 
+        one of the value tuples in keys, with one query.
+        """
+        filters = dict((name+"__in", list(set(key[i] for key in keys))) 
+                       for i, name in enumerate(names))
+        existing = {}
+        for row in self.model._default_manager.filter(**filters).values_list('pk', *names):
+            existing.setdefault(tuple(row[1:]), set()).add(row[0])
+        return existing
     
+    def _unique_message(self, instance, names):
+        message = instance.unique_error_message(self.model, list(names))
+        if isinstance(message, ValidationError):
+            message = message.messages[0]
+        return unicode(message)
     
-    def save_csv(self, file):
+    def _validate_parallel(self, headers, rows, pkg):
+        """
+        Validates rows on a pool of validate_workers processes, 
+        validate_chunk_size rows per task (see _validate_chunk()). Each worker
+        uses its own database connection. Results are merged back in row 
+        order so pkg['errors'] is the same as a serial validation. Yields
+        the plan entries of each task, or None if they could not be passed 
+        back from the workers. Stops once max_errors is reached.
+        """
+        workers = self.options['validate_workers']
+        pending = collections.deque()
+        seen = {}  # See _check_unique()
+        
+        # Forked workers must not share the parent's database connection.
+        _close_connections()
+        pool = multiprocessing.Pool(workers, initializer=_close_connections)
+        try:
+            row_num = 1
+            for chunk in self._iter_chunks(rows, self.options['validate_chunk_size']):
+                args = (self.app_model, self.options, headers, chunk, row_num)
+                pending.append(pool.apply_async(_validate_chunk, (args,)))
+                row_num += len(chunk)
+                self.timings.rows = row_num - 1
+                
+                # Keep a few tasks queued per worker without reading the 
+                # whole file into the pool.
+                while len(pending) >= 2*workers:
+                    yield self._merge_task(pending.popleft().get(), pkg, seen)
+                if self._errors_spent(pkg):
+                    break
+            
+            while pending and not self._errors_spent(pkg):
+                yield self._merge_task(pending.popleft().get(), pkg, seen)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    
+    def _merge_task(self, result, pkg, seen):
+        """
+        Merges a _validate_chunk() result into pkg and returns its entries. 
+        The workers only see their own chunk, so duplicates of unique values
+        across the file are checked here.
+        """
+        errors = len(pkg['errors'])
+        with self._phase('validate'):
+            entries = _merge_chunk(result, pkg)
+        if entries and self._batch_unique():
+            with self._phase('unique'):
+                entries = self._check_unique(entries, pkg, seen, db=False)
+            pkg['errors'][errors:] = sorted(pkg['errors'][errors:], key=_error_row)
+        return entries
+    
+    def save_csv(self, file, plan=None, checkpoint=None, progress=None, 
+                 backup_file=None, total_rows=None):
         
         """ 
         Takes a CSV file and saves it to the database. 
@@ -227,119 +1138,297 @@ class CSVTool():
             
         If duplicate_entry is not entered, use the model default.
         
+        If plan is given it must be the ['plan'] returned by validate_csv() 
+        (with the keep_plan option) for the same file. The plan is written as is and the file is not read
+        again. A plan can only be saved once.
+        
+        If the bulk_write option is set rows are committed batch_size at a 
+        time, each batch in one transaction. Every row is still its own 
+        INSERT or UPDATE. Many-to-many fields are not saved in bulk mode.
+        
+        Long imports (see submit_import()) can pass
+        * checkpoint - row number of the last row already saved. Rows up to 
+                       and including it are skipped.
+        * progress - called with this CSVTool after every LOOKUP_CHUNK_SIZE 
+                     rows, see _apply_plan(). Each chunk is committed in one
+                     transaction before it is reported.
+        * backup_file - journal of an earlier, interrupted run to add to.
+        * total_rows - number of data rows in the file, for the eta.
+        
         Returns a dict with keys
             'row_num':row_num, 
             'msg':rs,
             'created':created,
             'overwritten':overwritten,
-            'ignored':ignored
+            'ignored':ignored,
+            'unchanged':unchanged - overwrite rows left as they were, see the
+                        skip_unchanged option
+            'backup_file':backup_file,
+            'rows_done', 'rows_per_sec', 'eta', 'checkpoint' - see _apply_plan()
+            'timings' - see _Timings.finish()
             
         """      
 
         duplicate_entry = self.options['duplicate_entry']
-        pk = self.parent_field or 'id'
+        pk = self._get_parent_key()
+        self.timings = _Timings(self, 'save_csv')
            
-        backup_file = self._dump_table() 
-        
-        # Reset the file position and read it again.
-        file.seek(0)             
-        dialect = csv_mod.Sniffer().sniff(codecs.EncodedFile(file,"utf-8").read(2048))
-        file.seek(0) 
-        csv = csv_mod.DictReader( codecs.EncodedFile(file,"utf-8"), dialect=dialect )
+        # Journal the rows this import changes so revert() can undo them.
+        # Only a resumed import adds to an existing journal, a new one gets
+        # a name of its own even if another import starts in the same second.
+        resume = bool(backup_file)
+        if not backup_file:
+            backup_file = "%s_%s.journal" %(self._get_fname(), uuid.uuid4().hex)
+        
+        if plan is None:
+            # Read the spooled copy validate_csv() made, or spool it now.
+            with self._phase('sniff'):
+                upload = self._open_upload(file)
+                if upload.error:
+                    raise ValueError(upload.error)
+            csv = upload.rows()
+            self._compile_converter(csv.next())
+            rows = (row for row in csv if row)
+            if checkpoint:
+                # Data rows start at row 2, the header is row 1.
+                rows = itertools.islice(rows, checkpoint-1, None)
+            plan = self._iter_plan(rows, None, checkpoint or 1)
+        elif checkpoint:
+            plan = (entry for entry in plan if entry['row'] > checkpoint)
                 
-        #csv = csv_mod.DictReader(csv)
-        row = csv.next()
-        row_num = 1
-        count = 0
+        rs=[]
         self.created = []
         self.overwritten = 0
         self.ignored = 0
-        rs=[]
-        write_type = ''
-        while row:
-            row = self._convert_fk_names(row)
-            try:
-                row_id = row[pk]
-            except KeyError:
-                row_id = None
-            
-            if row_id:
-                
-                try:
-                    obj, parent_id = self._get_obj_or_none( row_id )
-                except:
-                    raise Exception("More than one entry found. Cannot overwrite all of them.")
-                    
-                if obj:
-                    if self.parent_key:
-                        row.pop(pk)
-                        row.update( {self.local_field+"_id":parent_id })
-                                        
-                    form = self._get_existing_form(row, obj)                    
-                    if form:
-                        instance = form.save()
-                        if self.parent_key:
-                            fe = FishEncounter.objects.get(pk=parent_id)
-                            instance.fishencounter = fe
-                            instance.save()
-                            
-                else:    
-                    form = self.form(row)
-                    form.__setattr__(pk, row_id)
-                    instance = form.save()
-                    #form = self.form(row)
-                    #instance.id=int(row['id'])
-                    #instance.save()
-                    self.created.append({'row':row_num,'id':instance.id})
-                    
-            else:
-                # Does not have row_id so just created the entry
-                instance = self.form(row).save()
-                self.created.append({'row':row_num,'id':instance.id})
-            try:
-                row = csv.next()    
-            except StopIteration:
-                row = False
-            row_num +=1
-                
+        self.unchanged = 0
+        self.backup_file = backup_file
+        self._journal = _ChangeJournal(os.path.join(TEMP_DIR, backup_file), self.model, 
+                                       append=resume)
+        try:
+            row_num = self._apply_plan(plan, checkpoint, progress, total_rows)
+        finally:
+            self._journal.close()
+            self._close_upload()
+            _bump_table_version(self.model)
+            self.timings.rows = self.progress['rows_done'] if hasattr(self, 'progress') else 0
+            timings = self.timings.finish()
         #raise Exception("Want to see ids")
         
-        return {'row_num':row_num, 
+        out = {'row_num':row_num, 
                 'msg':rs,
                 'created':self.created,
                 'overwritten':self.overwritten,
                 'ignored':self.ignored,
+                'unchanged':self.unchanged,
                 'backup_file':backup_file,
+                'timings':timings,
                 }
+        out.update(self.progress)
+        return out
+    
+    def _open_upload(self, file):
+        """
+        Returns the _SpooledUpload for file. The upload is spooled the first
+        time, so validate_csv() and save_csv() of the same file share one 
+        copy and one sniffed dialect.
+        """
+        if self._upload is not None and self._upload.source is file:
+            return self._upload
+        self._close_upload()
+        self._upload = _SpooledUpload(file, self.options['delimiter'], 
+                                      self.options['quotechar'])
+        return self._upload
+    
+    def _close_upload(self):
+        if self._upload is not None:
+            self._upload.close()
+            self._upload = None
+    
+    def _apply_plan(self, plan, checkpoint=None, progress=None, total_rows=None):
+        """
+        Writes the entries of an import plan and counts them in created, 
+        overwritten and ignored. The current values of the entries that will 
+        be overwritten are journaled first, LOOKUP_CHUNK_SIZE entries per 
+        query. Returns the row_num for save_csv().
+        
+        Keeps self.progress up to date, a dict with keys
+            'rows_done': rows written (or ignored) by this call
+            'rows_per_sec': rows_done per second
+            'eta': estimated seconds left, if total_rows is known
+            'checkpoint': row number of the last row saved
+        and calls progress(self) after every chunk. With a progress callback 
+        each chunk is written in one transaction and the callback runs 
+        inside it, so what it records commits or rolls back with the rows.
+        """
+        batch_size = 1
+        if self.options['bulk_write']:
+            batch_size = self.options['batch_size']
+        creates = []  # plan entries waiting to be inserted
+        updates = []  # plan entries waiting to be updated
+        
+        started = time.time()
+        self.progress = {'rows_done':0, 'rows_per_sec':0.0, 'eta':None, 
+                         'checkpoint':checkpoint or 1}
+        row_num = 1
+        for chunk in self._iter_chunks(plan):
+            if progress:
+                with _atomic():
+                    self._chunk_atomic = True
+                    try:
+                        self._apply_chunk(chunk, creates, updates, batch_size)
+                        self._write_batch(creates, updates)
+                        self._update_progress(chunk, started, total_rows)
+                        progress(self)
+                    finally:
+                        self._chunk_atomic = False
+            else:
+                self._apply_chunk(chunk, creates, updates, batch_size)
+                self._update_progress(chunk, started, total_rows)
+            row_num += len(chunk)
+        
+        self._write_batch(creates, updates)
+        return row_num
+    
+    def _update_progress(self, chunk, started, total_rows=None):
+        done = self.progress['rows_done'] + len(chunk)
+        rate = done / max(time.time() - started, 1e-6)
+        self.progress.update({'rows_done':done, 'rows_per_sec':rate,
+                              'checkpoint':chunk[-1]['row']})
+        if total_rows:
+            left = total_rows - (chunk[-1]['row'] - 1)
+            self.progress['eta'] = max(left, 0) / rate
+    
+    def _apply_chunk(self, chunk, creates, updates, batch_size):
+        """
+        Journals and writes (or queues) the plan entries of one chunk.
+        """
+        with self._phase('journal'):
+            self._journal.record_updates([entry['id'] for entry in chunk 
+                                          if entry['action'] == 'overwrite'])
+        for entry in chunk:
+            if entry['action'] == 'create':
+                creates.append(entry)
+            elif entry['action'] == 'overwrite':
+                updates.append(entry)
+                self.overwritten += 1
+            elif entry['action'] == 'unchanged':
+                self.unchanged += 1
+            else:
+                self.ignored += 1
+            
+            if len(creates) + len(updates) >= batch_size:
+                self._write_batch(creates, updates)
+    
+    def _write_batch(self, creates, updates):
+        """
+        Writes the instances of the queued plan entries and records the 
+        created ids. Outside of bulk_write mode every instance is saved on its
+        own like form.save() would. The queues are emptied in place.
+        """
+        if creates or updates:
+            with self._phase('save'):
+                self._write_queued(creates, updates)
+        
+        # created rows are counted from the first data row, not the header.
+        for entry in creates:
+            self.created.append({'row':entry['row']-1,'id':entry['instance'].id})
+        with self._phase('journal'):
+            self._journal.record_creates([entry['instance'].pk for entry in creates])
+        del creates[:]
+        del updates[:]
+    
+    def _write_queued(self, creates, updates):
+        if self.options['bulk_write'] and self._chunk_atomic:
+            # commit_on_success() does not nest, a batch transaction inside
+            # the chunk's would commit the chunk half way.
+            self._bulk_create([entry['instance'] for entry in creates])
+            self._bulk_update([entry['instance'] for entry in updates])
+        elif self.options['bulk_write']:
+            with _atomic():
+                self._bulk_create([entry['instance'] for entry in creates])
+                self._bulk_update([entry['instance'] for entry in updates])
+        else:
+            for entry in creates + updates:
+                entry['instance'].save()
+                if entry['save_m2m']:
+                    entry['save_m2m']()
+    
+    def _phase(self, name):
+        """
+        Returns a context manager that times a phase of the current run, see
+        _Timings. Does nothing outside of a timed run.
+        """
+        if self.timings is None:
+            return _no_phase()
+        return self.timings.phase(name)
+    
+    def _bulk_create(self, instances):
+        """
+        Inserts instances one by one inside the batch transaction. Django 
+        1.3 has no bulk_create(), and we need the new ids for the 'created'
+        report.
+        """
+        for instance in instances:
+            instance.save()
+    
+    def _bulk_update(self, instances):
+        """
+        Updates instances one by one inside the batch transaction. They are
+        known to exist, so save() is told to skip its SELECT and just UPDATE.
+        """
+        for instance in instances:
+            instance.save(force_update=True)
     
     def revert(self, fname):
         """
-        Load the SQL dump file gernerated while saving a CSV but only if the
-        filename's time stamp is less than REVERT_DT seconds old. 
+        Undo a save_csv() with the change journal it wrote (its 'backup_file')
+        but only if the filename's time stamp is less than REVERT_DT seconds
+        old. Created entries are deleted and overwritten entries are restored,
+        the rest of the table is not touched. SQL dump files from 
+        _dump_table() are loaded as before.
         
         Inputs
         ------ 
         fname [STRING] - the filename to be loaded. This filename was gernated by
-                         _dumpt_table() and contains the dump stimestamp.
+                         save_csv() or _dumpt_table() and contains the dump stimestamp.
         """ 
         
         now = dt.datetime.now()
         delta = now - self._fname2dt(fname)
         
         if delta.seconds < REVERT_DT:
-            self._load_table(fname)
+            if fname.endswith(".sql"):
+                self._load_table(fname)
+            else:
+                self._undo_journal(fname)
+            _bump_table_version(self.model)
             return {}
         else:
             return {'error':"File was older than the allowed revert time limit."}           
     
     
+    def _undo_journal(self, fname):
+        """
+        Reverts the changes recorded in a _ChangeJournal file in one 
+        transaction. Entries are restored newest first, so a row overwritten
+        twice ends up with its value from before the import.
+        """
+        path = os.path.join(TEMP_DIR, fname)
+        with _atomic():
+            for kind, data in reversed(_ChangeJournal.read(path)):
+                if kind == 'C':
+                    self.model._default_manager.filter(pk__in=data).delete()
+                else:
+                    for obj in serializers.deserialize('json', data):
+                        obj.save()
+    
     def _get_existing_form(self, row, obj):
         """
         Returns an bound form based on the row data and options dict.    
         
         Inputs
         ------
-        * row [DICT] - A file row dict generated from the CSV DictReader() method.
+        * row [DICT] - A file row dict generated by the converter from _compile_converter().
         * options [DICT] - Options dict with keys duplicate_entry and parent_key. 
             Keys
             ====
@@ -353,49 +1442,58 @@ class CSVTool():
         de = self.options['duplicate_entry']
         
         if de == 'overwrite':
-            form = self.form(row, instance=obj)
-            self.overwritten += 1
+            form = self._make_form(row, obj)
         
         elif de == 'add':
-            form = self.form(row)
+            form = self._make_form(row)
             
         
         elif de == 'ignore':
             form = None
-            self.ignored += 1
         
         return form
     
         
-    def _convert_fk_names(self, row):
+    def _compile_converter(self, headers):
         """
-        Loops through a given row and converts it's foreign key names to attribute names.
-        Also converts blank entries to null. 
-        Also checks to see if foreign key is an integer. If not sets it to -1 and lets form
-        errors handle it.
-            
+        Builds the row converter for a file with the given headers and sets it
+        as self._convert_row. The converter takes a row list from csv.reader 
+        and returns a dict that:
+        
+        * uses field names for foreign key columns (e.g. 'track_id' -> 'track')
+        * converts blank entries to None in columns that allow null
+        * sets foreign keys that are not integers to -1 and lets form errors 
+          handle it.
+        
+        Everything that depends only on the headers is worked out here once 
+        instead of for every cell.
         """
-        out = {}
-        for name in row:
-            
-            # If the entry is blank and Nulls are allowed convert blanks to None
-            if not row[name] and self.is_null(name): 
-                row[name] = None
-                        
-            tmp = name.split("_id")
-            if len(tmp) > 1:
-                # check that foreign key is an integer, if not sets it to -1 and lets form validation handle it
+        nullable = set(f.attname for f in self.model._meta.fields if f.null)
+        fk_names = dict((f.attname, f.name) for f in self.model._meta.fields 
+                        if f.__class__.__name__ == 'ForeignKey')
+        
+        keys = [fk_names.get(name, name) for name in headers]
+        null_keys = [key for name, key in zip(headers, keys) if name in nullable]
+        fk_keys = [key for name, key in zip(headers, keys) if name in fk_names]
+        width = len(keys)
+        
+        def convert(row):
+            if len(row) < width:
+                # Missing cells are None like DictReader's
+                row = list(row) + [None]*(width - len(row))
+            out = dict(zip(keys, row))
+            for key in null_keys:
+                if not out[key]:
+                    out[key] = None
+            for key in fk_keys:
                 try:
-                    int(row[name])
-                except:
-                    row[name] = -1
-                                   
-                out.update({tmp[0]:row[name]})
-                
-            else:
-                out.update({name:row[name]})
-            
-        return out
+                    int(out[key])
+                except (TypeError, ValueError):
+                    out[key] = -1
+            return out
+        
+        self._convert_row = convert
+        return convert
                 
     def is_null(self, name):
         """
@@ -424,22 +1522,44 @@ class CSVTool():
         else:
             return True
     
-    def _validate_row(self, row, options, pkg, row_num):
+    def _get_parent_key(self):
         """
-        Takes the headers, a row, and a the form and validates the row 
-        against the form using the headers
-        
+        Sets parent_key, local_field and parent_field from the options and 
+        returns the name of the column used to find existing entries.
         """
-        
-        #form = self.form(row)
         pk='id'
-        row_id = None        
         self.parent_key = self.options['parent_key']
         self.local_field = ''
         self.parent_field = ''
         if self.parent_key:
             self.local_field, self.parent_field = self.parent_key.split("__")
             pk=self.parent_field
+        return pk
+    
+    def _validate_row(self, row, options, pkg, row_num, resolved=None):
+        """
+        Takes the headers, a row, and a the form and validates the row 
+        against the form using the headers. resolved is the lookup for the 
+        row's chunk returned by _resolve_ids().
+        
+        Returns the row's plan entry or False if the row is invalid. If pkg is
+        None an invalid row raises a ValueError instead.
+        
+        """
+        
+        if pkg is None:
+            pkg = {'errors':[]}
+            entry = self._validate_row(row, options, pkg, row_num, resolved)
+            if pkg['errors']:
+                raise ValueError("Row %s could not be saved: %s" %(row_num, pkg['errors'][0]['msg']))
+            return entry
+        
+        #form = self.form(row)
+        row_id = None        
+        obj = None
+        parent_id = None
+        before = None
+        pk = self._get_parent_key()
         
         try:
             row_id = row[pk]
@@ -462,7 +1582,7 @@ class CSVTool():
             #obj, parent_id = self._get_obj_or_none( row_id )
                         
             try:
-                obj, parent_id = self._get_obj_or_none( row_id )
+                obj, parent_id = self._get_obj_or_none( row_id, resolved )
             except MultipleEntriesFound:
                 pkg['errors'].append({'row':row_num, 
                                       'msg':{self.parent_field:["More than one entry with %s = %s. Cannot overwrite all of them" %(self.parent_field, row_id)]
@@ -471,7 +1591,7 @@ class CSVTool():
                 return False
             except ParentNotFound:
                 pkg['errors'].append({'row':row_num, 
-                                     'msg':{self.parent_field:["Cannot find FishEncounter with %s = %s." %(self.parent_field, row_id)]
+                                     'msg':{self.parent_field:["Cannot find %s with %s = %s." %(self._get_parent_model().__name__, self.parent_field, row_id)]
                                            }
                                      })
                 return False
@@ -481,13 +1601,16 @@ class CSVTool():
                     row.pop(pk)
                     row.update( {self.local_field+"_id":parent_id })                
                 
+                if self.options['skip_unchanged']:
+                    # The form changes obj, keep its values to compare.
+                    before = self._field_values(obj)
                 form =self._get_existing_form(row, obj)
                 if form:
                     if not form.is_valid():
                         pkg['errors'].append({'row':row_num, 'msg':form.errors})
                         return False 
             else:               
-                form = self.form(row)
+                form = self._make_form(row)
                 form.__setattr__(pk, row_id)
                 # fishencount_id = fe.id               
                 
@@ -496,10 +1619,12 @@ class CSVTool():
                     return False        
         
         else:
-            form = self.form(row)
+            form = self._make_form(row)
             if not form.is_valid():
                 pkg['errors'].append({'row':row_num, 'msg':form.errors})
                 return False
+        
+        return self._plan_entry(row_num, form, obj, parent_id, before)
          
         """        
         if form.is_valid():
@@ -509,42 +1634,161 @@ class CSVTool():
             return False
         """
         
-    def _get_obj_or_none(self, row_id):
+    def _plan_entry(self, row_num, form, obj, parent_id, before=None):
+        """
+        Returns the import plan entry for a validated row, a dict with keys
+            'row': row number in the file
+            'action': 'create', 'overwrite', 'unchanged' or 'ignore'
+            'id': id of the entry that will be overwritten
+            'parent_id': id of the parent (parent_key only)
+            'instance': the unsaved instance with the row's cleaned data
+            'save_m2m': saves the form's many-to-many data once the instance
+                        is saved, or None
+        form is None for ignored rows. before are the _field_values() of obj
+        before the form changed it, given with the skip_unchanged option. An
+        overwrite that would leave every field as it was is 'unchanged' and
+        is not written.
+        """
+        entry = {'row':row_num, 'action':'ignore', 'id':None, 
+                 'parent_id':parent_id, 'instance':None, 'save_m2m':None}
+        if not form:
+            return entry
+        
+        instance = form.save(commit=False)
+        if self.parent_key and parent_id is not None:
+            # New children get their parent too, not just overwritten ones.
+            setattr(instance, self.local_field+"_id", parent_id)
+        if self.model._meta.many_to_many:
+            entry['save_m2m'] = form.save_m2m
+        
+        if instance.pk is None:
+            entry['action'] = 'create'
+        elif (before is not None and not entry['save_m2m'] and 
+              self._field_values(instance) == before):
+            entry['action'] = 'unchanged'
+            entry['id'] = instance.pk
+            return entry
+        else:
+            entry['action'] = 'overwrite'
+            entry['id'] = instance.pk
+        entry['instance'] = instance
+        return entry
+    
+    def _field_values(self, instance):
+        """
+        Returns the values of the concrete fields of instance by attname.
+        """
+        return dict((f.attname, getattr(instance, f.attname)) for f in self.model._meta.fields)
+    
+    def _get_obj_or_none(self, row_id, resolved=None):
         """
         Returns an object for the row_id or or a list or none. 
         Raises an exception is multiple entries are found. 
+        
+        resolved is the lookup returned by _resolve_ids() for the chunk the row 
+        is in. If it is not given the row_id is looked up on its own.
         """
+        if resolved is None:
+            resolved = self._resolve_ids([row_id])
+        key = self._lookup_value(row_id)
+        
         if self.parent_key:
-            # Need to generalize this.
-            
-            # if fish encounter does not exist catch exception in _validate_row()
-            try:
-                fe = FishEncounter.objects.get(barcode = row_id)                 
-            except FishEncounter.DoesNotExist:
+            # if the parent does not exist catch exception in _validate_row()
+            if key not in resolved['parents']:
                 raise ParentNotFound
-                
-            parent_id = fe.id
-            obj = self.model.objects.filter(fishencounter = fe)
-            #raise NameError
-            # If more than one object returned, what then?
-            if len(obj) > 1:
-                if self.options['duplicate_entry'] == 'overwrite':
-                    raise MultipleEntriesFound("Multiple records found. Cannot overwrite all of them.") 
-                else:
-                    obj = obj[0]
-            elif len(obj) == 1:
-                obj = obj[0]
-            else:
-                obj = None
-            
+            if key in resolved['multiple']:
+                raise MultipleEntriesFound("Multiple records found. Cannot overwrite all of them.") 
+            parent_id = resolved['parents'][key]
         else:
             parent_id = None
-                        
-            try:
-                obj = self.model.objects.get(pk=row_id)            
-            except self.model.DoesNotExist:
-                obj = None
+        
+        obj = resolved['objs'].get(key)
         return obj, parent_id
+    
+    def _resolve_ids(self, row_ids):
+        """
+        Looks up the existing entries for a chunk of row ids with one IN query
+        per table. Returns a dict with keys
+            'objs': {lookup value: existing object}
+            'parents': {lookup value: parent id} (parent_key only)
+            'multiple': set of lookup values with more than one existing entry
+                        when duplicate_entry is overwrite (parent_key only)
+        where the lookup value is the row id converted by _lookup_value().
+        """
+        resolved = {'objs':{}, 'parents':{}, 'multiple':set()}
+        keys = set(self._lookup_value(row_id) for row_id in row_ids)
+        keys.discard(None)
+        if not keys:
+            return resolved
+        
+        if self.parent_key:
+            parent_model = self._get_parent_model()
+            parents = parent_model.objects.filter(**{self.parent_field+"__in":keys})
+            for key, parent_id in parents.values_list(self.parent_field, 'id'):
+                resolved['parents'][key] = parent_id
+            
+            ids = dict((parent_id, key) for key, parent_id in resolved['parents'].items())
+            children = []
+            if ids:
+                children = self.model.objects.filter(**{self.local_field+"__in":ids.keys()})
+            for obj in children:
+                key = ids[getattr(obj, self.local_field+"_id")]
+                if key in resolved['objs']:
+                    # If more than one object returned, use the first one 
+                    # unless we are supposed to overwrite them.
+                    if self.options['duplicate_entry'] == 'overwrite':
+                        resolved['multiple'].add(key)
+                else:
+                    resolved['objs'][key] = obj
+        else:
+            resolved['objs'] = self.model.objects.in_bulk(list(keys))
+        
+        return resolved
+    
+    def _lookup_value(self, row_id):
+        """
+        Converts a row id from the file to the python value of the field it is
+        looked up by. Returns None if it cannot be converted.
+        """
+        if self.parent_key:
+            field = self._get_parent_model()._meta.get_field(self.parent_field)
+        else:
+            field = self.model._meta.pk
+        try:
+            return field.to_python(row_id)
+        except ValidationError:
+            return None
+    
+    def _get_parent_model(self):
+        """
+        Returns the model the parent_key points to, e.g. FishEncounter.
+        """
+        return self.model._meta.get_field(self.local_field).rel.to
+    
+    def _get_row_ids(self, rows, pk):
+        """
+        Returns the non-empty values of the pk column in rows.
+        """
+        row_ids = []
+        for row in rows:
+            try:
+                row_id = row[pk]
+            except (KeyError, TypeError):
+                row_id = None
+            if row_id:
+                row_ids.append(row_id)
+        return row_ids
+    
+    def _iter_chunks(self, rows, size=LOOKUP_CHUNK_SIZE):
+        """
+        Yields lists of up to size rows from the rows iterator.
+        """
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, size))
+            if not chunk:
+                break
+            yield chunk
         
     def _get_model(self, app_model):
         if not app_model in self.MODELS:
@@ -565,7 +1809,7 @@ class CSVTool():
                                     
             out = {'name':field.attname,
                    'db_type':field.db_type(),
-                   'lookup_codes':self._get_field_lookup_codes(field),
+                   'lookup_codes':_LazyLookupCodes(field),
                    'related_model':related_model,
                    'help_text':field.help_text,
                    'not_blank':not field.blank,
@@ -606,6 +1850,42 @@ class CSVTool():
         self.options = self.OPTIONS[self.app_model]
         if not 'parent_key' in self.options.keys():
             self.options.update({'parent_key':""})
+        if not 'bulk_write' in self.options.keys():
+            self.options.update({'bulk_write':False})
+        if not 'batch_size' in self.options.keys():
+            self.options.update({'batch_size':BULK_BATCH_SIZE})
+        if not 'prevalidate' in self.options.keys():
+            self.options.update({'prevalidate':True})
+        if not 'validate_workers' in self.options.keys():
+            self.options.update({'validate_workers':1})
+        if not 'validate_chunk_size' in self.options.keys():
+            self.options.update({'validate_chunk_size':VALIDATE_CHUNK_SIZE})
+        if not 'delimiter' in self.options.keys():
+            self.options.update({'delimiter':None})
+        if not 'quotechar' in self.options.keys():
+            self.options.update({'quotechar':None})
+        if not 'export_cache' in self.options.keys():
+            self.options.update({'export_cache':False})
+        if not 'export_workers' in self.options.keys():
+            self.options.update({'export_workers':1})
+        if not 'export_compression' in self.options.keys():
+            self.options.update({'export_compression':None})
+        if not 'watermark_field' in self.options.keys():
+            self.options.update({'watermark_field':None})
+        if not 'tombstones' in self.options.keys():
+            self.options.update({'tombstones':False})
+        if not 'skip_unchanged' in self.options.keys():
+            self.options.update({'skip_unchanged':False})
+        if not 'max_errors' in self.options.keys():
+            self.options.update({'max_errors':None})
+        if not 'collapse_errors' in self.options.keys():
+            self.options.update({'collapse_errors':True})
+        if not 'compile_form' in self.options.keys():
+            self.options.update({'compile_form':True})
+        if not 'preload_fks' in self.options.keys():
+            self.options.update({'preload_fks':True})
+        if not 'keep_plan' in self.options.keys():
+            self.options.update({'keep_plan':False})
         
         return self.OPTIONS[self.app_model]
         
@@ -626,16 +1906,44 @@ class CSVTool():
         self.form = form
         return self.form
         
+    def _get_form_engine(self):
+        """
+        Compiles self.form into a _FormEngine that validates rows without 
+        building a form for each one. See _make_form().
+        """
+        self.form_engine = _FormEngine(self.form, self.model)
+        return self.form_engine
+    
+    def _make_form(self, row, instance=None):
+        """
+        Returns the bound form for a row dict from the converter. Forms the 
+        form engine can run (and the compile_form option is on) are run 
+        by it instead, which returns a _CleanedRow that works like the 
+        bound form. Foreign keys are checked against the ones preloaded for 
+        the row's chunk, if any.
+        """
+        if self.form_engine.usable and self.options['compile_form']:
+            return self.form_engine(row, instance, self._fk_keys)
+        if instance is None:
+            return self.form(row)
+        return self.form(row, instance=instance)
+    
+    @property
+    def lookup_codes(self):
+        """
+        Lookup codes for choice fields and small foreign key tables, built on
+        first access from the shared lookup code cache.
+        """
+        return self._get_lookup_codes()
+    
     def _get_lookup_codes(self):
         lookups = {}
         for field in self.model._meta.fields:
             if field.choices:
                 lookups.update({field.name:field.choices})
             if field.__class__.__name__ == 'ForeignKey':
-                related_model = field.rel.to
-                objs = related_model.objects.all()
-                if objs.count() < FK_LOOKUP_MAX:
-                    choices = [(obj.id, obj.__str__()) for obj in objs]
+                choices = _get_related_lookup_codes(field.rel.to)
+                if choices is not None:
                     lookups.update({field.name:choices})
             
             # Ad if field.foreign_key then and there
@@ -643,20 +1951,10 @@ class CSVTool():
             # make a choices list
             # and return it like is was a choice field.
                 
-        self.lookup_codes = lookups
-        return self.lookup_codes    
+        return lookups    
     
     def _get_field_lookup_codes(self, field):
-        choices = []
-        if field.choices:
-            choices = field.choices
-        if field.__class__.__name__ == 'ForeignKey':
-            related_model = field.rel.to
-            objs = related_model.objects.all()
-            if objs.count() < FK_LOOKUP_MAX:
-                choices = [(obj.id, obj.__str__()) for obj in objs]
-                
-        return choices
+        return _get_field_lookup_codes(field)
     
     def _get_foreign_keys(self):
         fks = {}
@@ -737,7 +2035,8 @@ class CSVTool():
     def _fname2dt(self, fname):
         
         base, ext = fname.split(".")
-        app, model, date_string, time_string = base.split("_")
+        # Journal names have a unique suffix after the time stamp.
+        app, model, date_string, time_string = base.split("_")[:4]
              
         return dt.datetime(int(date_string[0:4]), 
                            int(date_string[4:6]),
@@ -750,14 +2049,22 @@ class CSVTool():
         
         
       
-    def _make_csv_response(self, fields, body, fname=None):
+    def _make_csv_response(self, fields, body, fname=None, compression=None):
         """
         Returns an HttpResponse object filled with the content
-        from header = [] and body = [[]] as a csv object. 
+        from header = [] and body = [[]] as a csv object. With compression,
+        'gzip' or 'bz2', it is a compressed csv attachment instead.
             
         """
         if not fname:
             fname = self._get_fname()+".csv"
+        
+        if compression:
+            lines = self._iter_csv_lines(fields, body)
+            ext, content_type = COMPRESSIONS[compression][1:]
+            response = HttpResponse("".join(_compress(lines, compression)), mimetype=content_type)
+            response['Content-Disposition'] = 'attachment; filename=%s' %(fname + ext)
+            return response
                   
         # Convert from generator to list
         fields = list(fields)
@@ -772,6 +2079,1862 @@ class CSVTool():
             writer.writerow(row)
     
         return response
+    
+    def _make_streaming_csv_response(self, fields, body, fname=None, cache_path=None,
+                                     compression=None):
+        """
+        Same as _make_csv_response() but body may be a generator. Rows are 
+        encoded and sent STREAM_BUFFER_ROWS at a time as the response is 
+        consumed, so the body is never held in memory. If cache_path is 
+        given the lines are also written to that export cache entry.
+        
+        """
+        if not fname:
+            fname = self._get_fname()+".csv"
+        content_type = 'text/csv'
+        
+        lines = self._iter_csv_lines(fields, body, self.timings)
+        if cache_path:
+            lines = _cache_lines(lines, cache_path)
+        if compression:
+            lines = _compress(lines, compression)
+            ext, content_type = COMPRESSIONS[compression][1:]
+            fname += ext
+        if StreamingHttpResponse is not None:
+            response = StreamingHttpResponse(lines, content_type=content_type)
+        else:
+            response = HttpResponse(lines, mimetype=content_type)
+        response['Content-Disposition'] = 'attachment; filename=%s' %(fname)
+        
+        return response
+    
+    def _make_cached_response(self, cached, etag, stream, request, compression=None,
+                              fname=None):
+        """
+        Returns a response with the export cache entry in the open file 
+        cached. Clients that accept gzip get the entry as is, and so do gzip
+        attachments.
+        """
+        if not fname:
+            fname = self._get_fname()+".csv"
+        content_type = 'text/csv'
+        
+        content = _iter_file(cached)
+        gzipped = (not compression and request is not None and 
+                   'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if compression != 'gzip' and not gzipped:
+            content = _decompress(content, 'gzip')
+        if compression:
+            if compression != 'gzip':
+                content = _compress(content, compression)
+            ext, content_type = COMPRESSIONS[compression][1:]
+            fname += ext
+        
+        if stream:
+            if StreamingHttpResponse is not None:
+                response = StreamingHttpResponse(content, content_type=content_type)
+            else:
+                response = HttpResponse(content, mimetype=content_type)
+        else:
+            response = HttpResponse("".join(content), mimetype=content_type)
+        
+        if gzipped:
+            response['Content-Encoding'] = 'gzip'
+        response['Vary'] = 'Accept-Encoding'
+        response['ETag'] = etag
+        response['Content-Disposition'] = 'attachment; filename=%s' %(fname)
+        return response
+    
+    def _iter_csv_lines(self, fields, body, timings=None):
+        """
+        Yields utf-8 encoded csv text for the header and body rows. If 
+        timings are given the row fetching is timed and the timings are 
+        finished after the last line.
+        """
+        writer = csv_mod.writer(_Echo())
+        try:
+            yield writer.writerow(_encode_row(fields))
+            
+            buf = []
+            body = iter(body)
+            while True:
+                if timings:
+                    with timings.phase('query'):
+                        row = next(body, None)
+                else:
+                    row = next(body, None)
+                if row is None:
+                    break
+                buf.append(writer.writerow(_encode_row(row)))
+                if len(buf) >= STREAM_BUFFER_ROWS:
+                    if timings:
+                        timings.rows += len(buf)
+                    yield "".join(buf)
+                    buf = []
+            if buf:
+                if timings:
+                    timings.rows += len(buf)
+                yield "".join(buf)
+        finally:
+            if timings:
+                timings.finish()
+
+
+def _table_version(model):
+    """
+    Returns a token that changes whenever the table of model does: its row 
+    count, largest primary key and latest auto_now timestamp, if it has 
+    one, read with one aggregate query. It is built from the database only,
+    so every process gets the same token for the same table.
+    """
+    aggregates = {'count':Count('pk'), 'max_pk':Max('pk')}
+    for f in model._meta.fields:
+        if getattr(f, 'auto_now', False):
+            aggregates['modified'] = Max(f.name)
+            break
+    values = model._default_manager.aggregate(**aggregates)
+    return "%s|%s|%s" %(values['count'], values['max_pk'], values.get('modified'))
+
+
+def _bump_table_version(model):
+    _TABLE_VERSIONS[model] = _TABLE_VERSIONS.get(model, 0) + 1
+    if model in _shared_version_models():
+        _bump_shared_version(model)
+
+
+def _shared_version_models():
+    """
+    Returns the set of models whose changes every process counts for the 
+    export cache: the models with the export_cache option and their 
+    parent_key models.
+    """
+    global _SHARED_VERSION_MODELS
+    if _SHARED_VERSION_MODELS is None:
+        models = set()
+        for app_model, options in CSVTOOL_MODELS.items():
+            if options.get('export_cache'):
+                model = get_model(*app_model.split("."))
+                models.add(model)
+                if options.get('parent_key'):
+                    local_field = options['parent_key'].split("__")[0]
+                    models.add(model._meta.get_field(local_field).rel.to)
+        _SHARED_VERSION_MODELS = models
+    return _SHARED_VERSION_MODELS
+
+
+def _version_path(model):
+    return os.path.join(EXPORT_CACHE_DIR, "%s.%s.version" 
+                        %(model._meta.app_label, model._meta.object_name))
+
+
+def _shared_version(model):
+    """
+    Returns the change counter of model that every process shares, for 
+    changes the database state of _table_version() does not show (e.g. an
+    overwrite of a table without auto_now). It is the id on the first line
+    of the counter file and the file's size, see _bump_shared_version().
+    """
+    try:
+        f = open(_version_path(model), 'rb')
+    except IOError:
+        return "0"
+    try:
+        return "%s:%d" %(f.readline().strip(), os.fstat(f.fileno()).st_size)
+    finally:
+        f.close()
+
+
+def _bump_shared_version(model):
+    """
+    Appends a byte to the change counter file of model. A missing file, or
+    one of more than EXPORT_VERSION_MAX bytes, is replaced by one with a 
+    new id, so a counter never repeats.
+    """
+    if not os.path.isdir(EXPORT_CACHE_DIR):
+        os.makedirs(EXPORT_CACHE_DIR)
+    path = _version_path(model)
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        size = None
+    if size is None or size > EXPORT_VERSION_MAX:
+        tmp = "%s.%s.tmp" %(path, uuid.uuid4().hex)
+        f = open(tmp, 'wb')
+        try:
+            f.write(uuid.uuid4().hex + "\n")
+        finally:
+            f.close()
+        os.rename(tmp, path)
+    else:
+        f = open(path, 'ab')
+        try:
+            f.write(".")
+        finally:
+            f.close()
+
+
+def _table_changed(sender, **kwargs):
+    _bump_table_version(sender)
+
+post_save.connect(_table_changed, dispatch_uid='csvtool_table_version_save')
+post_delete.connect(_table_changed, dispatch_uid='csvtool_table_version_delete')
+
+
+def _record_tombstone(sender, instance=None, **kwargs):
+    """
+    Appends the time and id of a deleted entry to the tombstone log of its
+    model if the model has the tombstones option, see 
+    get_delta_fields_body(). There is one log file per day; starting a new 
+    one removes the files older than TOMBSTONE_MAX_AGE.
+    """
+    app_model = "%s.%s" %(sender._meta.app_label, sender._meta.object_name)
+    if not CSVTOOL_MODELS.get(app_model, {}).get('tombstones'):
+        return
+    if not os.path.isdir(TOMBSTONE_DIR):
+        os.makedirs(TOMBSTONE_DIR)
+    now = _now()
+    path = os.path.join(TOMBSTONE_DIR, "%s.%s.log" %(app_model, now.strftime("%Y%m%d")))
+    if not os.path.exists(path):
+        _prune_tombstones(app_model, now)
+    f = open(path, 'ab')
+    try:
+        f.write("%s\t%s\n" %(now, instance.pk))
+    finally:
+        f.close()
+
+post_delete.connect(_record_tombstone, dispatch_uid='csvtool_tombstones')
+
+
+def _tombstone_logs(app_model):
+    """
+    Returns [(day, path), ...] of the daily tombstone logs of app_model, 
+    day as 'YYYYMMDD'.
+    """
+    logs = []
+    for fname in os.listdir(TOMBSTONE_DIR):
+        parts = fname[len(app_model)+1:].split(".")
+        if fname.startswith(app_model+".") and len(parts) == 2 and parts[1] == "log":
+            if len(parts[0]) == 8 and parts[0].isdigit():
+                logs.append((parts[0], os.path.join(TOMBSTONE_DIR, fname)))
+    return sorted(logs)
+
+
+def _prune_tombstones(app_model, now):
+    oldest = (now - dt.timedelta(seconds=TOMBSTONE_MAX_AGE)).strftime("%Y%m%d")
+    for day, path in _tombstone_logs(app_model):
+        if day < oldest:
+            try:
+                os.remove(path)
+            except OSError:
+                pass  # Removed by another process
+
+
+def _read_tombstones(app_model, field, since=None):
+    """
+    Returns the tombstones of app_model as a list of (deleted, pk), with 
+    the times converted by the watermark field. Only the daily logs from 
+    the day before since on are read.
+    """
+    if not os.path.isdir(TOMBSTONE_DIR):
+        return []
+    first = ""
+    if since is not None:
+        # A day early, since may be in another time zone than the logs.
+        first = (since - dt.timedelta(days=1)).strftime("%Y%m%d")
+    tombstones = []
+    for day, path in _tombstone_logs(app_model):
+        if day < first:
+            continue
+        f = open(path, 'rb')
+        try:
+            for line in f:
+                deleted, pk = line.rstrip("\n").split("\t", 1)
+                tombstones.append((field.to_python(deleted), pk))
+        finally:
+            f.close()
+    return tombstones
+
+
+def _cache_lines(lines, path):
+    """
+    Yields lines and writes them gzipped to the export cache entry at path 
+    as they pass. The entry only appears at path after the last line, so 
+    an export that is cut short leaves nothing behind.
+    """
+    tmp = "%s.%s.tmp" %(path, uuid.uuid4().hex)
+    raw = open(tmp, 'wb')
+    out = gzip.GzipFile(os.path.basename(path)[:-len(".gz")], 'wb', fileobj=raw)
+    done = False
+    try:
+        for line in lines:
+            out.write(line)
+            yield line
+        done = True
+    finally:
+        out.close()
+        raw.close()
+        if done:
+            os.rename(tmp, path)
+            _evict_export_cache(keep=path)
+        else:
+            os.remove(tmp)
+
+
+def _evict_export_cache(keep=None):
+    """
+    Removes export cache entries older than EXPORT_CACHE_MAX_AGE, then the
+    least recently used ones until the cache is under EXPORT_CACHE_MAX_SIZE.
+    The entry at keep, the one just written, is never removed, nor are the
+    change counters of _shared_version().
+    """
+    now = time.time()
+    entries = []
+    size = 0
+    for fname in os.listdir(EXPORT_CACHE_DIR):
+        if fname.endswith(".version") or ".version." in fname:
+            continue
+        path = os.path.join(EXPORT_CACHE_DIR, fname)
+        try:
+            stat = os.stat(path)
+            if now - stat.st_mtime > EXPORT_CACHE_MAX_AGE and path != keep:
+                os.remove(path)
+                continue
+        except OSError:
+            continue  # Removed by another process
+        size += stat.st_size
+        if not fname.endswith(".tmp") and path != keep:
+            entries.append((stat.st_mtime, stat.st_size, path))
+    
+    for mtime, entry_size, path in sorted(entries):
+        if size <= EXPORT_CACHE_MAX_SIZE:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        size -= entry_size
+
+
+def _iter_file(f):
+    """
+    Yields the contents of f SPOOL_BUFFER_SIZE bytes at a time and closes it.
+    """
+    try:
+        for chunk in iter(lambda: f.read(SPOOL_BUFFER_SIZE), ''):
+            yield chunk
+    finally:
+        f.close()
+
+
+def submit_import(app_model, file, options=None):
+    """
+    Queues a background save_csv() of file, which should already have passed
+    validate_csv(), and returns the job id. The upload is copied to JOB_DIR 
+    so the job can be resumed after a restart. See get_import_job().
+    """
+    if not os.path.isdir(JOB_DIR):
+        os.makedirs(JOB_DIR)
+    job_id = uuid.uuid4().hex
+    _claim_job(job_id)
+    
+    file.seek(0)
+    if hasattr(file, 'chunks'):
+        chunks = file.chunks()
+    else:
+        chunks = iter(lambda: file.read(65536), '')
+    out = open(_job_path(job_id, ".csv"), 'wb')
+    try:
+        for chunk in chunks:
+            out.write(chunk)
+    finally:
+        out.close()
+    
+    tool_options = CSVTool(app_model).options
+    tool_options.update(options or {})
+    upload = _SpooledUpload(_job_path(job_id, ".csv"), tool_options['delimiter'], 
+                            tool_options['quotechar'])
+    total_rows = sum(1 for row in upload.rows() if row) - 1
+    
+    now = time.time()
+    job = {'id':job_id, 'app_model':app_model, 'options':options or {},
+           'status':'queued', 'error':None, 'result':None,
+           'total_rows':total_rows, 'rows_per_sec':0.0, 'eta':None, 
+           'backup_file':None, 'submitted':now, 'updated':now}
+    job.update(_JOB_START)
+    _save_job(job)
+    _queue_job(job_id)
+    return job_id
+
+
+def get_import_job(job_id):
+    """
+    Returns the state of an import job, a dict with keys
+        'status': 'queued', 'running', 'done' or 'failed'
+        'rows_done', 'total_rows', 'rows_per_sec', 'eta', 'checkpoint'
+        'created_count', 'overwritten', 'ignored', 'unchanged'
+        'result': the save_csv() result dict once the job is done, with 
+                  'created_count' instead of the 'created' list
+        'error': the error message if it failed
+    The created rows are read with get_import_job_created().
+    """
+    f = open(_job_path(job_id, ".json"), 'rb')
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+
+def get_import_job_created(job_id):
+    """
+    Yields {'row':row, 'id':id} for every entry an import job created so 
+    far, like save_csv()['created'].
+    """
+    for record, offset in _iter_job_log(job_id):
+        for created in record['created']:
+            yield created
+
+
+def resume_import_jobs():
+    """
+    Queues every job that was queued or running when the process stopped. 
+    Running jobs continue after their last committed chunk. Call it at 
+    startup; every job is claimed by one process only, see _claim_job().
+    Returns the job ids.
+    """
+    if not os.path.isdir(JOB_DIR):
+        return []
+    resumed = []
+    for fname in sorted(os.listdir(JOB_DIR)):
+        if fname.endswith(".json"):
+            job_id = fname[:-len(".json")]
+            if not get_import_job(job_id)['status'] in ('queued', 'running'):
+                continue
+            if not _claim_job(job_id):
+                continue
+            # Another process may have finished it before we got the claim.
+            if get_import_job(job_id)['status'] in ('queued', 'running'):
+                _queue_job(job_id)
+                resumed.append(job_id)
+            else:
+                _release_job(job_id)
+    return resumed
+
+
+_JOB_QUEUE = Queue.Queue()
+_JOB_THREADS = []
+_JOB_LOCK = threading.Lock()
+_JOB_CLAIMS = {}  # job id: open lock file, held while this process has the job
+# Counters of a job and where it continues, as recorded after every chunk.
+_JOB_START = {'checkpoint':1, 'rows_done':0, 'created_count':0, 'overwritten':0, 
+              'ignored':0, 'unchanged':0}
+
+
+def _claim_job(job_id):
+    """
+    Takes the lock file of a job with flock(), so only one process runs it.
+    Returns False if another process, or this one, already has it. The lock
+    is released when the process ends, so the job of a crashed process can 
+    be claimed again.
+    """
+    f = open(_job_path(job_id, ".lock"), 'a')
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        f.close()
+        return False
+    with _JOB_LOCK:
+        _JOB_CLAIMS[job_id] = f
+    return True
+
+
+def _release_job(job_id):
+    with _JOB_LOCK:
+        f = _JOB_CLAIMS.pop(job_id, None)
+    if f is not None:
+        f.close()
+
+
+def _queue_job(job_id):
+    with _JOB_LOCK:
+        while len(_JOB_THREADS) < JOB_WORKERS:
+            thread = threading.Thread(target=_job_worker, name="csvtool-import")
+            thread.daemon = True
+            thread.start()
+            _JOB_THREADS.append(thread)
+    _JOB_QUEUE.put(job_id)
+
+
+def _job_worker():
+    while True:
+        job_id = _JOB_QUEUE.get()
+        try:
+            _run_job(job_id)
+        except Exception:
+            pass  # _run_job() records the error in the job
+        finally:
+            _release_job(job_id)
+            _close_connections()
+
+
+def _run_job(job_id):
+    """
+    Runs save_csv() for a job from its last committed chunk. After every 
+    chunk the job's counters and created rows are appended to its log 
+    (see _log_job_chunk()) and its state is saved, both inside the chunk's 
+    transaction. Counts from earlier runs of the job are added to the 
+    result.
+    """
+    job = get_import_job(job_id)
+    if job['status'] == 'running':
+        job.update(_last_committed(job))
+    job['status'] = 'running'
+    _save_job(job)
+    
+    tool = CSVTool(job['app_model'])
+    tool.options.update(job['options'])
+    start = dict((key, job[key]) for key in _JOB_START)
+    logged = [0]  # tool.created entries already in the log
+    
+    def counts(tool):
+        return {'rows_done':start['rows_done'] + tool.progress['rows_done'],
+                'created_count':start['created_count'] + len(tool.created),
+                'overwritten':start['overwritten'] + tool.overwritten,
+                'ignored':start['ignored'] + tool.ignored,
+                'unchanged':start['unchanged'] + tool.unchanged}
+    
+    def progress(tool):
+        job.update(tool.progress)
+        job.update(counts(tool))
+        job['backup_file'] = tool.backup_file
+        _log_job_chunk(job, tool.created[logged[0]:])
+        logged[0] = len(tool.created)
+        _save_job(job)
+    
+    f = open(_job_path(job_id, ".csv"), 'rb')
+    try:
+        result = tool.save_csv(f, checkpoint=job['checkpoint'], progress=progress,
+                               backup_file=job['backup_file'], 
+                               total_rows=job['total_rows'])
+    except Exception as e:
+        # The chunk that failed may have logged itself before rolling back.
+        try:
+            job.update(_last_committed(job))
+        except Exception:
+            pass  # Sorted out if the job is ever run again
+        job.update({'status':'failed', 'error':str(e)})
+        _save_job(job)
+        raise
+    finally:
+        f.close()
+    
+    del result['created']  # See get_import_job_created()
+    result.update(counts(tool))
+    job.update(result)
+    job.update({'status':'done', 'result':result})
+    _save_job(job)
+    os.remove(_job_path(job_id, ".csv"))
+    os.remove(_job_path(job_id, ".lock"))
+
+
+def _log_job_chunk(job, created):
+    """
+    Appends the counters and checkpoint of a job after a chunk, with the 
+    rows the chunk created, as one JSON line to the job's log. Called inside
+    the chunk's transaction, so the last line may be of a chunk that never 
+    committed, see _last_committed().
+    """
+    record = dict((key, job[key]) for key in _JOB_START)
+    record['created'] = created
+    f = open(_job_path(job['id'], ".log"), 'ab')
+    try:
+        f.write(json.dumps(record) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+
+
+def _iter_job_log(job_id):
+    """
+    Yields (record, offset) for every line of a job's log.
+    """
+    path = _job_path(job_id, ".log")
+    if not os.path.exists(path):
+        return
+    f = open(path, 'rb')
+    try:
+        offset = 0
+        for line in f:
+            if line.endswith("\n"):  # A line cut off by a crash is not logged
+                yield json.loads(line), offset
+            offset += len(line)
+    finally:
+        f.close()
+
+
+def _last_committed(job):
+    """
+    Returns the _JOB_START counters of an interrupted job after its last 
+    committed chunk. The last line of the log committed if the rows it 
+    created are in the table. If it created none it is dropped as well, 
+    running such a chunk again creates nothing. Dropped lines are cut from
+    the log, so a crash never creates a chunk's rows twice.
+    """
+    last = previous = None
+    for record, offset in _iter_job_log(job['id']):
+        previous, last = last, (record, offset)
+    if last is None:
+        return dict(_JOB_START)
+    
+    record, offset = last
+    model = CSVTool(job['app_model']).model
+    if record['created'] and model._default_manager.filter(pk=record['created'][0]['id']).exists():
+        return dict((key, record[key]) for key in _JOB_START)
+    
+    f = open(_job_path(job['id'], ".log"), 'r+b')
+    try:
+        f.truncate(offset)
+    finally:
+        f.close()
+    if previous is None:
+        return dict(_JOB_START)
+    return dict((key, previous[0][key]) for key in _JOB_START)
+
+
+def _save_job(job):
+    """
+    Writes a job's state. The file is replaced in one step so a crash never 
+    leaves half a state behind.
+    """
+    job['updated'] = time.time()
+    path = _job_path(job['id'], ".json")
+    f = open(path + ".tmp", 'wb')
+    try:
+        json.dump(job, f)
+    finally:
+        f.close()
+    os.rename(path + ".tmp", path)
+
+
+def _job_path(job_id, ext):
+    return os.path.join(JOB_DIR, job_id + ext)
+
+
+def import_bundle(files, options=None, workers=BUNDLE_WORKERS):
+    """
+    Validates and saves uploads of several related models as one import.
+    
+    Inputs
+    ------
+    * files [DICT] - {app_model: file} for models in CSVTOOL_MODELS.
+    * options [DICT] - {app_model: options dict} passed to validate_csv(). 
+                       Optional.
+    * workers [INT] - tables validated and saved at the same time. With 1
+                      they run one after another in the calling thread.
+    
+    Tables are loaded in the order of bundle_order(): a table is validated
+    once the tables of the bundle it refers to are saved, so its parent_key
+    and foreign keys find their new entries. The tables of one level do not
+    depend on each other and are validated, then saved, on a pool of 
+    workers threads. If a table does not validate or fails to save, the 
+    tables already saved are reverted with their change journals, so the 
+    bundle is saved as a whole or not at all.
+    
+    Returns a dict with keys
+        'is_valid': False if a table did not validate or save
+        'order': the levels of bundle_order()
+        'errors': {app_model: validate_csv() errors, or [message] if 
+                  save_csv() failed}
+        'results': {app_model: save_csv() result} of the tables saved
+        'backup_files': [(app_model, backup_file), ...] in the order saved, 
+                        for revert_bundle()
+        'reverted': True if tables were saved and then all reverted
+        'revert_errors': {app_model: message} of saved tables that could 
+                         not be reverted, they are still in the database
+    """
+    options = options or {}
+    order = bundle_order(files.keys())
+    out = {'is_valid':True, 'order':order, 'errors':{}, 'results':{},
+           'backup_files':[], 'reverted':False, 'revert_errors':{}}
+    workers = min(workers, max([len(level) for level in order] or [1]))
+    pool = None
+    if workers > 1:
+        pool = ThreadPool(workers)
+    try:
+        for level in order:
+            validated = _bundle_map(pool, _validate_bundle_table, 
+                                    [(app_model, files[app_model], options.get(app_model)) 
+                                     for app_model in level])
+            for app_model, tool, pkg in validated:
+                if not pkg['is_valid']:
+                    out['errors'][app_model] = pkg['errors']
+            if out['errors']:
+                for app_model, tool, pkg in validated:
+                    if tool is not None:
+                        tool._close_upload()
+                break
+            
+            saved = _bundle_map(pool, _save_bundle_table, 
+                                [(tool, files[app_model], pkg['plan']) 
+                                 for app_model, tool, pkg in validated])
+            for (app_model, tool, pkg), (result, error) in zip(validated, saved):
+                # A failed save_csv() has journaled what it wrote so far.
+                if getattr(tool, 'backup_file', None):
+                    out['backup_files'].append((app_model, tool.backup_file))
+                if error:
+                    out['errors'][app_model] = [error]
+                else:
+                    out['results'][app_model] = result
+            if out['errors']:
+                break
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    
+    if out['errors']:
+        out['is_valid'] = False
+        if out['backup_files']:
+            out['revert_errors'] = _rollback_bundle(out['backup_files'])
+            out['reverted'] = not out['revert_errors']
+    return out
+
+
+def bundle_order(app_models):
+    """
+    Returns app_models as a list of levels, lists of app_models that can be
+    loaded one level after another: every model comes after the models of 
+    app_models its foreign keys refer to (see CSVTool._get_foreign_keys())
+    and the models of a level do not depend on each other. Raises a 
+    ValueError for circular foreign keys.
+    """
+    tools = dict((app_model, CSVTool(app_model)) for app_model in app_models)
+    by_name = dict((tool.model.__name__, app_model) for app_model, tool in tools.items())
+    depends = {}
+    for app_model, tool in tools.items():
+        depends[app_model] = set(by_name[name] for name in tool.fks.values() 
+                                 if name in by_name and by_name[name] != app_model)
+    
+    order = []
+    done = set()
+    while len(done) < len(depends):
+        level = sorted(app_model for app_model in depends 
+                       if not app_model in done and depends[app_model] <= done)
+        if not level:
+            raise ValueError("Circular foreign keys between %s" 
+                             %", ".join(sorted(set(depends) - done)))
+        order.append(level)
+        done.update(level)
+    return order
+
+
+def revert_bundle(backup_files):
+    """
+    Reverts a bundle saved by import_bundle() with its 'backup_files', the
+    tables that refer to others first. Nothing is reverted if any of them is
+    older than REVERT_DT seconds.
+    """
+    tools = [(CSVTool(app_model), fname) for app_model, fname in backup_files]
+    now = dt.datetime.now()
+    for tool, fname in tools:
+        if now - tool._fname2dt(fname) >= dt.timedelta(seconds=REVERT_DT):
+            return {'error':"File was older than the allowed revert time limit."}
+    for tool, fname in reversed(tools):
+        result = tool.revert(fname)
+        if result.get('error'):
+            return {'error':"%s: %s" %(tool.app_model, result['error'])}
+    return {}
+
+
+def _rollback_bundle(backup_files):
+    """
+    Undoes the tables import_bundle() saved before one failed, newest 
+    first. Unlike revert() there is no REVERT_DT limit, a long bundle must 
+    still roll back. Returns {app_model: message} of the tables that could 
+    not be undone.
+    """
+    failed = {}
+    for app_model, backup_file in reversed(backup_files):
+        tool = CSVTool(app_model)
+        try:
+            tool._undo_journal(backup_file)
+        except Exception as e:
+            failed[app_model] = str(e)
+        finally:
+            _bump_table_version(tool.model)
+    return failed
+
+
+def _bundle_map(pool, func, items):
+    """
+    Returns map(func, items), run on pool if there is one. Pool threads 
+    close their database connections after each item.
+    """
+    if pool is None:
+        return map(func, items)
+    
+    def run(item):
+        try:
+            return func(item)
+        finally:
+            _close_connections()
+    return pool.map(run, items)
+
+
+def _validate_bundle_table(args):
+    """
+    Runs validate_csv() for one table of import_bundle(). Returns 
+    (app_model, tool, pkg); an exception is returned as the error.
+    """
+    app_model, file, options = args
+    options = dict(options or {})
+    options.setdefault('keep_plan', True)
+    tool = None
+    try:
+        tool = CSVTool(app_model)
+        pkg = tool.validate_csv(file, options)
+    except Exception as e:
+        pkg = {'is_valid':False, 'errors':[str(e)], 'plan':None}
+    return app_model, tool, pkg
+
+
+def _save_bundle_table(args):
+    """
+    Runs save_csv() with the plan of one table of import_bundle(). Returns
+    (result, None) or (None, error message).
+    """
+    tool, file, plan = args
+    try:
+        return tool.save_csv(file, plan=plan), None
+    except Exception as e:
+        return None, str(e)
+
+
+class _SpooledUpload(object):
+    """
+    An upload read once into a file in TEMP_DIR, checked to be utf-8 on the 
+    way, that can then be read as csv rows as often as needed without 
+    reading or transcoding the upload again. Uploads that are already on 
+    disk (TemporaryUploadedFile, plain files) are checked and read in place.
+    gzip and bz2 uploads, recognized by their magic bytes, are decompressed
+    into the spooled copy as they are read.
+    
+    The dialect is sniffed once from the first SNIFF_SIZE bytes, or built 
+    from delimiter and quotechar when given. Files of SPOOL_MMAP_SIZE bytes 
+    or more are read through mmap, so memory use does not grow with the file.
+    """
+    def __init__(self, file, delimiter=None, quotechar=None):
+        self.source = file
+        self.delimiter = delimiter
+        self.quotechar = quotechar
+        self.error = None
+        self.offset = 0  # Skips a utf-8 byte order mark
+        self.newline = "\n"
+        self._dialect = None
+        self._temp = None
+        
+        self.path = _disk_path(file)
+        if self.path is None:
+            file.seek(0)
+            src = file
+        else:
+            src = open(self.path, 'rb')
+        out = None
+        
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        try:
+            magic = src.read(3)
+            self.compression = _get_compression(magic)
+            if self.path is None or self.compression:
+                fd, self.path = tempfile.mkstemp(suffix=".csv", dir=TEMP_DIR)
+                self._temp = self.path
+                out = os.fdopen(fd, 'wb')
+            
+            chunks = itertools.chain([magic], iter(lambda: src.read(SPOOL_BUFFER_SIZE), ''))
+            if self.compression:
+                chunks = _decompress(chunks, self.compression)
+            
+            first = True
+            for chunk in chunks:
+                text = chunk
+                if first:
+                    if chunk.startswith(codecs.BOM_UTF8):
+                        self.offset = len(codecs.BOM_UTF8)
+                        text = chunk[self.offset:]
+                    first = False
+                self._check(decoder, text)
+                if out is not None:
+                    out.write(chunk)
+            self._check(decoder, '', True)
+        except (IOError, EOFError, zlib.error):
+            self.error = "Could not decompress the file. Please check that it is a complete %s file." %self.compression
+        finally:
+            if out is not None:
+                out.close()
+            if src is not file:
+                src.close()
+        self.size = os.path.getsize(self.path)
+        
+        # Files saved with old Mac line endings only have carriage returns.
+        head = self.head()
+        if "\r" in head and not "\n" in head:
+            self.newline = "\r"
+    
+    def _check(self, decoder, text, final=False):
+        if self.error is None:
+            try:
+                decoder.decode(text, final)
+            except UnicodeDecodeError:
+                self.error = "The file is not utf-8 encoded. Please save it as utf-8 (CSV UTF-8) and upload it again."
+    
+    def head(self):
+        f = open(self.path, 'rb')
+        try:
+            f.seek(self.offset)
+            return f.read(SNIFF_SIZE)
+        finally:
+            f.close()
+    
+    def dialect(self):
+        """
+        Returns the csv dialect of the file. Raises csv.Error if it can not
+        be sniffed.
+        """
+        if self._dialect is None:
+            if self.delimiter:
+                base = csv_mod.excel
+            else:
+                base = csv_mod.Sniffer().sniff(self.head())
+            class dialect(base):
+                pass
+            if self.delimiter:
+                dialect.delimiter = str(self.delimiter)
+            if self.quotechar:
+                dialect.quotechar = str(self.quotechar)
+            self._dialect = dialect
+        return self._dialect
+    
+    def rows(self):
+        """
+        Yields the rows of the file, headers first, as lists of utf-8 strings.
+        """
+        f = open(self.path, 'rb')
+        data = None
+        try:
+            if self.size >= SPOOL_MMAP_SIZE:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = f
+            data.seek(self.offset)
+            if self.newline == "\n":
+                lines = iter(data.readline, '')
+            else:
+                lines = _split_lines(data, self.newline)
+            for row in csv_mod.reader(lines, dialect=self.dialect()):
+                yield row
+        finally:
+            if data is not None and data is not f:
+                data.close()
+            f.close()
+    
+    def close(self):
+        """
+        Removes the spooled copy. The upload itself is left alone.
+        """
+        if self._temp is not None:
+            try:
+                os.remove(self._temp)
+            except OSError:
+                pass
+            self._temp = None
+    
+    __del__ = close
+
+
+def _get_compression(magic):
+    """
+    Returns the COMPRESSIONS name of a file starting with the bytes magic,
+    or None if it is not compressed.
+    """
+    for name, (prefix, ext, content_type) in COMPRESSIONS.items():
+        if magic.startswith(prefix):
+            return name
+    return None
+
+
+def _decompress(chunks, compression):
+    """
+    Yields the decompressed data of a gzip or bz2 file read in chunks. 
+    Files of several concatenated streams are read as one.
+    """
+    decompressor = None
+    for chunk in chunks:
+        while chunk:
+            if decompressor is None:
+                if compression == 'gzip':
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                else:
+                    decompressor = bz2.BZ2Decompressor()
+            try:
+                data = decompressor.decompress(chunk)
+            except EOFError:
+                # bz2 stream ended right at the end of the last chunk.
+                decompressor = None
+                continue
+            if data:
+                yield data
+            # Input after the end of a stream starts the next one.
+            chunk = decompressor.unused_data
+            if chunk:
+                decompressor = None
+    
+    if decompressor is not None:
+        # Feed one more byte, it is left over only if the stream is complete.
+        try:
+            decompressor.decompress('\0')
+        except EOFError:
+            return
+        if decompressor.unused_data != '\0':
+            raise IOError("Compressed file is truncated")
+
+
+def _compress(lines, compression):
+    """
+    Yields lines compressed with gzip or bz2, so a csv can be sent 
+    compressed as it is generated.
+    """
+    if compression == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    else:
+        compressor = bz2.BZ2Compressor()
+    for line in lines:
+        data = compressor.compress(line)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _disk_path(file):
+    """
+    Returns the path of the file on disk behind an upload, or None if it is 
+    only in memory.
+    """
+    if isinstance(file, basestring):
+        return file
+    if hasattr(file, 'temporary_file_path'):
+        return file.temporary_file_path()
+    file = getattr(file, 'file', file)
+    if isinstance(file, types.FileType) and os.path.isfile(file.name):
+        return file.name
+    return None
+
+
+def _split_lines(data, newline):
+    """
+    Yields the lines of data ending in newline, reading SPOOL_BUFFER_SIZE 
+    bytes at a time.
+    """
+    rest = ''
+    for chunk in iter(lambda: data.read(SPOOL_BUFFER_SIZE), ''):
+        lines = (rest + chunk).split(newline)
+        rest = lines.pop()
+        for line in lines:
+            yield line + newline
+    if rest:
+        yield rest
+
+
+class _ChangeJournal(object):
+    """
+    Records what an import changes so it can be reverted: the current values
+    of the rows it overwrites and the ids of the rows it creates. The journal
+    is a file of lines 'U<tab>data' (serialized pre-images) and 'C<tab>data'
+    (created ids), data compressed and base64 encoded, so its size follows 
+    the import, not the table. Every line is synced to disk before the chunk
+    that wrote it commits, so a crash loses at most a last, cut off line of
+    a chunk that never committed.
+    """
+    def __init__(self, path, model, append=False):
+        self.model = model
+        if append and os.path.exists(path):
+            _cut_partial_line(path)
+        self.file = open(path, 'ab' if append else 'wb')
+    
+    def record_updates(self, ids):
+        """
+        Journals the current values of the entries with ids, in one query.
+        """
+        if ids:
+            objs = self.model._default_manager.filter(pk__in=ids)
+            self._write('U', serializers.serialize('json', objs))
+    
+    def record_creates(self, ids):
+        if ids:
+            self._write('C', json.dumps(ids))
+    
+    def _write(self, kind, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.file.write("%s\t%s\n" %(kind, base64.b64encode(zlib.compress(data))))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+    
+    def close(self):
+        self.file.close()
+    
+    @staticmethod
+    def read(path):
+        """
+        Returns the journal at path as a list of ('U', json) and 
+        ('C', [ids]) in the order they were recorded. A last line cut off
+        by a crash is left out.
+        """
+        entries = []
+        journal = open(path, 'rb')
+        try:
+            for line in journal:
+                if not line.endswith("\n"):
+                    break
+                kind, data = line.rstrip("\n").split("\t", 1)
+                data = zlib.decompress(base64.b64decode(data))
+                if kind == 'C':
+                    data = json.loads(data)
+                entries.append((kind, data))
+        finally:
+            journal.close()
+        return entries
+
+
+def _cut_partial_line(path):
+    """
+    Cuts a last line without a newline, left by a crash, off the file at 
+    path so lines appended next start on their own.
+    """
+    f = open(path, 'r+b')
+    try:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        pos = end
+        while pos > 0:
+            step = min(SPOOL_BUFFER_SIZE, pos)
+            f.seek(pos - step)
+            block = f.read(step)
+            newline = block.rfind("\n")
+            if newline != -1:
+                pos = pos - step + newline + 1
+                break
+            pos -= step
+        if pos != end:
+            f.truncate(pos)
+    finally:
+        f.close()
+
+
+def _validate_chunk(args):
+    """
+    Parallel validation task. Validates a chunk of raw csv rows in a worker 
+    process and returns (errors, plan) for _merge_chunk(). plan is None if 
+    the entries cannot be sent back to the parent process.
+    """
+    app_model, options, headers, rows, row_num = args
+    tool = CSVTool(app_model)
+    tool.options = options
+    tool._compile_converter(headers)
+    
+    pkg = {'errors':[]}
+    # Duplicates across chunks are checked by the parent, see _validate_parallel().
+    plan = list(tool._iter_plan(rows, pkg, row_num, in_file=False))
+    if [entry for entry in plan if entry['save_m2m']]:
+        plan = None
+    
+    errors = []
+    for error in pkg['errors']:
+        msg = error['msg']
+        if isinstance(msg, ErrorDict):
+            # Lazy translations do not pickle, send plain strings.
+            msg = ('form', dict((name, [unicode(m) for m in messages]) 
+                                for name, messages in msg.items()))
+        else:
+            msg = ('plain', msg)
+        errors.append({'row':error['row'], 'msg':msg})
+    
+    return errors, plan
+
+
+def _export_shard(args):
+    """
+    export_to_file() task. Writes the rows of qs in one primary key range,
+    bounds, to the part file path and returns the number of rows. The part
+    starts with the header if header is set.
+    """
+    app_model, options, query, bounds, path, header = args
+    tool = CSVTool(app_model)
+    tool.options = options
+    qs = tool.model._default_manager.all()
+    qs.query = query
+    if bounds:
+        qs = qs.filter(pk__gte=bounds[0], pk__lte=bounds[1])
+    
+    fields, body = tool.iter_fields_body(qs)
+    rows = 0
+    f = open(path, 'wb')
+    try:
+        writer = csv_mod.writer(f)
+        if header:
+            writer.writerow(_encode_row(fields))
+        for row in body:
+            writer.writerow(_encode_row(row))
+            rows += 1
+    finally:
+        f.close()
+    return rows
+
+
+def _merge_chunk(result, pkg):
+    """
+    Adds the errors of a _validate_chunk() task to pkg and returns its plan
+    entries, or None if it had none.
+    """
+    errors, chunk_plan = result
+    for error in errors:
+        kind, msg = error['msg']
+        if kind == 'form':
+            msg = ErrorDict((name, ErrorList(messages)) for name, messages in msg.items())
+        pkg['errors'].append({'row':error['row'], 'msg':msg})
+    return chunk_plan
+
+
+class _FormEngine(object):
+    """
+    Validates rows with the fields of a ModelForm class, built once, instead
+    of a new form for every row. Each field's clean() is called directly on
+    the row's value, the cleaned values are set on the instance and the 
+    model validation runs like in ModelForm.is_valid(). Errors come out in
+    the same ErrorDict format.
+    
+    Calling the engine with a row returns a _CleanedRow, which has the 
+    is_valid(), errors, cleaned_data and save(commit=False) of a bound form.
+    Unique fields are not checked row by row, CSVTool._check_unique() checks
+    them for a whole chunk. Foreign keys can be looked up for a whole chunk 
+    with preload() too.
+    Forms with hooks of their own (clean(), clean_<field>(), __init__() ...)
+    or with file or many-to-many fields have usable False and must be run 
+    as forms.
+    """
+    HOOKS = ('__init__', 'full_clean', '_clean_fields', '_clean_form', '_post_clean',
+             'clean', 'is_valid', 'save', 'validate_unique', '_get_validation_exclusions')
+    
+    def __init__(self, form_class, model):
+        self.model = model
+        self.fields = form_class.base_fields.items()
+        self.usable = self._is_usable(form_class)
+        
+        model_fields = dict((f.name, f) for f in model._meta.fields)
+        # Model fields set from the cleaned data, like construct_instance().
+        self.construct = [model_fields[name] for name, field in self.fields
+                          if name in model_fields and model_fields[name].editable 
+                          and not isinstance(model_fields[name], AutoField)]
+        # Model fields the model validation never checks.
+        self.exclude = [f.name for f in model._meta.fields if not f.name in form_class.base_fields]
+        # Model fields left out of the model validation when they are empty.
+        self.optional = [name for name, field in self.fields 
+                         if name in model_fields and not model_fields[name].blank 
+                         and not field.required]
+        
+        # (names, attnames) of the unique fields and unique_together sets 
+        # that are all in the form, see CSVTool._check_unique().
+        self.unique_checks = []
+        sets = [(f.name,) for f in model._meta.fields if f.unique]
+        sets.extend(tuple(names) for names in model._meta.unique_together)
+        for names in sets:
+            if not [name for name in names if name in self.exclude]:
+                attnames = tuple(model_fields[name].attname for name in names)
+                self.unique_checks.append((names, attnames))
+        self.date_checks = bool([f for f in model._meta.fields 
+                                 if f.unique_for_date or f.unique_for_month or f.unique_for_year])
+        
+        # name: (related key field, cacheable) of the foreign keys whose 
+        # choices preload() can look up, see _get_existing_keys().
+        self.foreign_keys = {}
+        for name, field in self.fields:
+            model_field = model_fields.get(name)
+            if not isinstance(field, ModelChoiceField) or not isinstance(model_field, ForeignKey):
+                continue
+            rel_field = model_field.rel.get_related_field()
+            key = field.to_field_name or 'pk'
+            if key != rel_field.name and not (key == 'pk' and rel_field.primary_key):
+                continue
+            cacheable = not field.queryset.query.where.children
+            self.foreign_keys[name] = (rel_field, cacheable)
+    
+    def _is_usable(self, form_class):
+        for name in dir(form_class):
+            if name.startswith('clean_'):
+                return False
+        for name in self.HOOKS:
+            attr = getattr(form_class, name, None)
+            base = getattr(BaseModelForm, name, None)
+            if getattr(attr, 'im_func', attr) is not getattr(base, 'im_func', base):
+                return False
+        for name, field in self.fields:
+            if isinstance(field, (FileField, ModelMultipleChoiceField)):
+                return False
+        return True
+    
+    def __call__(self, data, instance=None, fk_keys=None):
+        if instance is None:
+            instance = self.model()
+        return _CleanedRow(self, data, instance, fk_keys)
+    
+    def preload(self, rows):
+        """
+        Returns {field name: keys} for the foreign keys of rows, where keys 
+        is a set that has every key of the rows that exists. Uses one IN 
+        query per related model, or none for hot tables. 
+        """
+        fk_keys = {}
+        for name, field in self.fields:
+            if not name in self.foreign_keys:
+                continue
+            rel_field, cacheable = self.foreign_keys[name]
+            values = set()
+            for row in rows:
+                value = field.widget.value_from_datadict(row, {}, name)
+                if value in _EMPTY_VALUES:
+                    continue
+                try:
+                    values.add(rel_field.to_python(value))
+                except ValidationError:
+                    pass
+            fk_keys[name] = _get_existing_keys(field.queryset, rel_field, values, cacheable)
+        return fk_keys
+    
+    def clean(self, data, instance, fk_keys=None):
+        """
+        Cleans data into instance. Returns the cleaned data and the errors.
+        Foreign keys in fk_keys, from preload(), are checked against it 
+        without a query; their cleaned data is the key, not the related 
+        object.
+        """
+        cleaned = {}
+        errors = ErrorDict()
+        preloaded = []
+        for name, field in self.fields:
+            value = field.widget.value_from_datadict(data, {}, name)
+            try:
+                if fk_keys is not None and name in fk_keys and not value in _EMPTY_VALUES:
+                    cleaned[name] = self._clean_key(name, field, value, fk_keys[name])
+                    preloaded.append(name)
+                else:
+                    cleaned[name] = field.clean(value)
+            except ValidationError as e:
+                errors[name] = ErrorList(e.messages)
+        
+        for f in self.construct:
+            if f.name in preloaded:
+                # Only the key is known, drop a related object cached for 
+                # the old one.
+                instance.__dict__.pop(f.get_cache_name(), None)
+                setattr(instance, f.attname, cleaned[f.name])
+            elif f.name in cleaned:
+                f.save_form_data(instance, cleaned[f.name])
+        
+        # Preloaded keys are known to exist, the model validation would 
+        # look each one up again.
+        exclude = self.exclude + errors.keys() + preloaded
+        exclude.extend(name for name in self.optional 
+                       if not name in errors and cleaned.get(name) in _EMPTY_VALUES)
+        
+        # Same steps as Model.full_clean(), but the unique checks are left 
+        # to CSVTool._check_unique() unless there are date checks.
+        steps = [lambda: instance.clean_fields(exclude=exclude), instance.clean]
+        if self.date_checks:
+            steps.append(lambda: instance.validate_unique(exclude=exclude))
+        for step in steps:
+            try:
+                step()
+            except ValidationError as e:
+                for name, messages in _error_dict(e).items():
+                    errors.setdefault(name, ErrorList()).extend(messages)
+                    cleaned.pop(name, None)
+                    if name != NON_FIELD_ERRORS and not name in exclude:
+                        exclude.append(name)
+        return cleaned, errors
+    
+    def _clean_key(self, name, field, value, keys):
+        rel_field = self.foreign_keys[name][0]
+        try:
+            key = rel_field.to_python(value)
+        except ValidationError:
+            key = None
+        if key is None or not key in keys:
+            raise ValidationError(field.error_messages['invalid_choice'])
+        return key
+
+
+class _CleanedRow(object):
+    """
+    A row run through a _FormEngine, used where a bound form would be.
+    """
+    save_m2m = None
+    
+    def __init__(self, engine, data, instance, fk_keys=None):
+        self.engine = engine
+        self.data = data
+        self.instance = instance
+        self.fk_keys = fk_keys
+        self.cleaned_data = None
+        self._errors = None
+    
+    @property
+    def errors(self):
+        if self._errors is None:
+            self.cleaned_data, self._errors = self.engine.clean(self.data, self.instance, self.fk_keys)
+        return self._errors
+    
+    def is_valid(self):
+        return not self.errors
+    
+    def save(self, commit=True):
+        if self.errors:
+            raise ValueError("The %s could not be saved because the data didn't validate." 
+                             %self.instance._meta.object_name)
+        if commit:
+            self.instance.save()
+        return self.instance
+
+
+def _error_dict(e):
+    """
+    Returns the errors of a ValidationError as {field name: [messages]}.
+    """
+    if hasattr(e, 'message_dict'):
+        return e.message_dict
+    return {NON_FIELD_ERRORS:e.messages}
+
+
+def _collapse_errors(errors):
+    """
+    Replaces each form error that repeats for one column on 
+    ERROR_COLLAPSE_MIN rows or more with a single error on its first row, 
+    e.g. "Enter a valid date. (89999 rows from row 2 to 90000)", that also 
+    has the keys 'last_row' and 'count'. Other errors are kept as they are.
+    """
+    counts = _ErrorCounts()
+    for error in errors:
+        counts.add(error)
+    repeated = counts.repeated(ERROR_COLLAPSE_MIN)
+    if not repeated:
+        return errors
+    
+    kept = [error for error in (counts.strip(error, repeated) for error in errors) if error]
+    return sorted(kept + counts.summaries(ERROR_COLLAPSE_MIN), key=_error_row)
+
+
+class _ErrorCounts(object):
+    """
+    Counts the rows each column error message occurs on, for 
+    _collapse_errors() and iter_validate_csv().
+    """
+    def __init__(self):
+        self.groups = collections.OrderedDict()  # (name, message): [first, last, rows]
+    
+    def add(self, error):
+        for name, message in _error_messages(error):
+            group = self.groups.get((name, message))
+            if group is None:
+                self.groups[(name, message)] = [error['row'], error['row'], 1]
+            else:
+                group[1] = error['row']
+                group[2] += 1
+    
+    def repeated(self, rows):
+        """
+        Returns the (name, message) keys that occurred on at least rows rows.
+        """
+        return set(key for key, group in self.groups.items() if group[2] >= rows)
+    
+    def strip(self, error, keys):
+        """
+        Returns error without the messages in keys, or None if no message is
+        left.
+        """
+        if not keys or not list(_error_messages(error)):
+            return error
+        msg = ErrorDict()
+        for name, messages in error['msg'].items():
+            left = [m for m in messages if not (name, unicode(m)) in keys]
+            if left:
+                msg[name] = ErrorList(left)
+        if not msg:
+            return None
+        return {'row':error['row'], 'msg':msg}
+    
+    def summaries(self, rows):
+        """
+        Returns one error for each message that occurred on at least rows 
+        rows.
+        """
+        errors = []
+        for (name, message), (first, last, count) in self.groups.items():
+            if count >= rows:
+                text = u"%s (%d rows from row %s to %s)" %(message, count, first, last)
+                errors.append({'row':first, 'last_row':last, 'count':count,
+                               'msg':ErrorDict({name:ErrorList([text])})})
+        return errors
+
+
+def _error_row(error):
+    """
+    Sort key of an error. File level errors (plain strings or without a 
+    row) go last.
+    """
+    row = error.get('row') if isinstance(error, dict) else None
+    return (row is None, row)
+
+
+def _error_messages(error):
+    """
+    Yields (column name, message) for every message of a form error.
+    """
+    if isinstance(error, dict) and isinstance(error.get('msg'), dict):
+        for name, messages in error['msg'].items():
+            for message in messages:
+                yield name, unicode(message)
+
+
+def _column_kind(db_type):
+    """
+    Returns the _prevalidate() kind for a database column type or None.
+    """
+    db_type = (db_type or '').lower()
+    if db_type.startswith(('int', 'bigint', 'smallint', 'tinyint', 'mediumint')):
+        return 'int'
+    if db_type.startswith(('numeric', 'decimal', 'double', 'real', 'float')):
+        return 'decimal'
+    if db_type.startswith(('datetime', 'timestamp')):
+        return 'datetime'
+    if db_type == 'date':
+        return 'date'
+    return None
+
+
+def _bad_values(kind, values, extra):
+    """
+    Returns the indexes of the values (non-blank csv strings) that are not 
+    valid for the column kind. Whole columns are converted with NumPy when 
+    it is available and only scanned value by value if that fails.
+    """
+    if kind == 'int':
+        if numpy is not None:
+            try:
+                numpy.array(values).astype(numpy.int64)
+                return []
+            except (ValueError, OverflowError, TypeError):
+                pass
+        return [i for i, value in enumerate(values) if not _INT_RE.match(value)]
+    
+    if kind == 'decimal':
+        if numpy is not None:
+            try:
+                numpy.array(values).astype(numpy.float64)
+                return []
+            except (ValueError, TypeError):
+                pass
+        bad = []
+        for i, value in enumerate(values):
+            try:
+                Decimal(value.strip())
+            except (InvalidOperation, ValueError):
+                bad.append(i)
+        return bad
+    
+    if kind in ('date', 'datetime'):
+        # Columns almost always use one format, try the last one that worked first.
+        bad = []
+        last = extra[0]
+        for i, value in enumerate(values):
+            value = value.strip()
+            for fmt in [last] + extra:
+                try:
+                    dt.datetime.strptime(value, fmt)
+                    last = fmt
+                    break
+                except ValueError:
+                    continue
+            else:
+                bad.append(i)
+        return bad
+    
+    if kind == 'choice':
+        bad = []
+        for i, value in enumerate(values):
+            if value not in extra and value.decode('utf-8', 'replace') not in extra:
+                bad.append(i)
+        return bad
+    
+    return []
+
+
+def _close_connections():
+    """
+    Closes every database connection of this process. They reopen on use.
+    """
+    for conn in connections.all():
+        conn.close()
+
+
+class _Timings(object):
+    """
+    Wall time and database query count per phase of one validate_csv(), 
+    save_csv() or qs2response() run. Queries are counted from 
+    connection.queries, with use_debug_cursor turned on for the run. Unless
+    DEBUG is on the queries are dropped again after every phase, so the 
+    list does not grow with the run. With the 'profile' option the run is 
+    also profiled with cProfile.
+    """
+    def __init__(self, tool, operation):
+        self.tool = tool
+        self.operation = operation
+        self.phases = {}
+        self.rows = 0
+        self.queries = 0
+        self.result = None
+        self.started = time.time()
+        
+        self._connection = connections['default']
+        self._debug_cursor = self._connection.use_debug_cursor
+        self._trim = not (settings.DEBUG or self._debug_cursor)
+        self._connection.use_debug_cursor = True
+        self._base = len(self._connection.queries)
+        
+        self._profiler = None
+        if tool.options and tool.options.get('profile'):
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+    
+    def query_count(self):
+        return self.queries + max(len(self._connection.queries) - self._base, 0)
+    
+    def _trim_queries(self):
+        """
+        Moves the queries logged since the last call into the count and 
+        drops them from connection.queries, unless DEBUG wants them.
+        """
+        if self._trim:
+            queries = self._connection.queries
+            self.queries += max(len(queries) - self._base, 0)
+            del queries[self._base:]
+    
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.time()
+        queries = self.query_count()
+        try:
+            yield
+        finally:
+            phase = self.phases.setdefault(name, {'seconds':0.0, 'queries':0})
+            phase['seconds'] += time.time() - started
+            phase['queries'] += self.query_count() - queries
+            self._trim_queries()
+    
+    def finish(self):
+        """
+        Ends the run and returns its timings, a dict with keys
+            'operation': 'validate_csv', 'save_csv', 'qs2response', 
+                         'delta2response' or 'export_to_file'
+            'seconds': total wall time
+            'queries': total query count
+            'rows': rows handled
+            'rows_per_sec': rows per second
+            'phases': {phase: {'seconds':..., 'queries':...}}
+            'profile': cProfile dump in TEMP_DIR, with the 'profile' option
+        The timings are also stored as the tool's last_timings, sent with the
+        csv_timings signal and passed to the tool's timing_callback. Later calls return the same dict.
+        """
+        if self.result is not None:
+            return self.result
+        
+        seconds = time.time() - self.started
+        queries = self.query_count()
+        self._trim_queries()
+        self._connection.use_debug_cursor = self._debug_cursor
+        
+        self.result = {'operation':self.operation,
+                       'seconds':seconds,
+                       'queries':queries,
+                       'rows':self.rows,
+                       'rows_per_sec':self.rows / max(seconds, 1e-6),
+                       'phases':self.phases,
+                       }
+        if self._profiler is not None:
+            self._profiler.disable()
+            fname = "%s_%s.prof" %(self.tool._get_fname(), self.operation)
+            self._profiler.dump_stats(os.path.join(TEMP_DIR, fname))
+            self.result['profile'] = fname
+        
+        self.tool.last_timings = self.result
+        csv_timings.send(sender=CSVTool, app_model=self.tool.app_model,
+                         operation=self.operation, timings=self.result)
+        if self.tool.timing_callback:
+            self.tool.timing_callback(self.result)
+        return self.result
+
+
+@contextlib.contextmanager
+def _no_phase():
+    yield
+
+
+class _Echo(object):
+    """
+    File-like object for csv.writer that returns what is written instead of 
+    storing it.
+    """
+    def write(self, value):
+        return value
+
+
+class _LazyLookupCodes(object):
+    """
+    The 'lookup_codes' list of a field description from _get_fields(). The 
+    codes are only looked up when the list is used, so building the field 
+    descriptions runs no queries.
+    """
+    def __init__(self, field):
+        self.field = field
+    
+    def _codes(self):
+        return _get_field_lookup_codes(self.field)
+    
+    def __iter__(self):
+        return iter(self._codes())
+    
+    def __len__(self):
+        return len(self._codes())
+    
+    def __nonzero__(self):
+        return bool(self._codes())
+    
+    def __getitem__(self, index):
+        return self._codes()[index]
+    
+    def __eq__(self, other):
+        return list(self._codes()) == list(other)
+    
+    def __repr__(self):
+        return repr(self._codes())
+
+
+def _get_field_lookup_codes(field):
+    choices = []
+    if field.choices:
+        choices = field.choices
+    if field.__class__.__name__ == 'ForeignKey':
+        codes = _get_related_lookup_codes(field.rel.to)
+        if codes is not None:
+            choices = codes
+            
+    return choices
+
+
+def _get_related_lookup_codes(related_model):
+    """
+    Returns [(id, str), ...] for every entry of related_model if it has less
+    than FK_LOOKUP_MAX entries, otherwise None. Uses one query with a LIMIT 
+    and caches the result for FK_LOOKUP_TTL seconds. The cache entry is 
+    dropped when an entry of related_model is saved or deleted.
+    """
+    now = time.time()
+    cached = _LOOKUP_CACHE.get(related_model)
+    if cached and cached[0] > now:
+        return cached[1]
+    
+    objs = list(related_model.objects.all()[:FK_LOOKUP_MAX])
+    codes = None
+    if len(objs) < FK_LOOKUP_MAX:
+        codes = [(obj.id, obj.__str__()) for obj in objs]
+    _LOOKUP_CACHE[related_model] = (now + FK_LOOKUP_TTL, codes)
+    return codes
+
+
+def invalidate_lookup_codes(related_model=None):
+    """
+    Drops the cached lookup codes of related_model, or all of them.
+    """
+    if related_model is None:
+        _LOOKUP_CACHE.clear()
+    else:
+        _LOOKUP_CACHE.pop(related_model, None)
+
+
+def _get_existing_keys(queryset, rel_field, values, cacheable=False):
+    """
+    Returns the set of values that are the rel_field of an entry in 
+    queryset, looked up with IN queries of LOOKUP_CHUNK_SIZE keys.
+    
+    With cacheable (queryset is the whole table) and a table of up to 
+    FK_KEYS_CACHE_ROWS entries every key is read once and kept for 
+    FK_LOOKUP_TTL seconds, or until the table changes in this process, for
+    the FK_KEYS_CACHE_TABLES most recently used tables. The cached keys only
+    confirm values, other processes may have added entries since, so values
+    not in them are still looked up.
+    """
+    existing = set()
+    if not values:
+        return existing
+    if cacheable:
+        model = queryset.model
+        cache_key = (model, rel_field.name)
+        now = time.time()
+        version = _TABLE_VERSIONS.get(model, 0)
+        with _FK_KEYS_LOCK:
+            cached = _FK_KEYS_CACHE.pop(cache_key, None)
+        if cached is None or cached[0] <= now or cached[1] != version:
+            keys = list(queryset.values_list(rel_field.name, flat=True)[:FK_KEYS_CACHE_ROWS+1])
+            if len(keys) > FK_KEYS_CACHE_ROWS:
+                keys = None  # Too big, look up values instead
+            else:
+                keys = set(keys)
+            cached = (now + FK_LOOKUP_TTL, version, keys)
+        with _FK_KEYS_LOCK:
+            _FK_KEYS_CACHE[cache_key] = cached
+            while len(_FK_KEYS_CACHE) > FK_KEYS_CACHE_TABLES:
+                _FK_KEYS_CACHE.popitem(last=False)
+        if cached[2] is not None:
+            existing = values & cached[2]
+            values = values - existing
+            if not values:
+                return existing
+    
+    values = list(values)
+    for i in range(0, len(values), LOOKUP_CHUNK_SIZE):
+        filters = {rel_field.name+"__in":values[i:i+LOOKUP_CHUNK_SIZE]}
+        existing.update(queryset.filter(**filters).values_list(rel_field.name, flat=True))
+    return existing
+
+
+def _lookup_codes_changed(sender, **kwargs):
+    _LOOKUP_CACHE.pop(sender, None)
+
+post_save.connect(_lookup_codes_changed, dispatch_uid='csvtool_lookup_codes_save')
+post_delete.connect(_lookup_codes_changed, dispatch_uid='csvtool_lookup_codes_delete')
+
+
+def _atomic():
+    """
+    Returns a context manager that runs a block in one transaction.
+    """
+    if hasattr(transaction, 'atomic'):
+        return transaction.atomic()
+    return transaction.commit_on_success()
+
+
+def _encode_row(row):
+    """
+    Encodes unicode values in a row to utf-8 so csv.writer can write them.
+    """
+    return [v.encode("utf-8") if isinstance(v, unicode) else v for v in row]
         
 #csv = CSVTool('wcgsi.Track')
 